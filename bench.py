@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*
+
+import os
+import sys
+import time
+import socket
+import inspect
+import fnmatch
+import logging
+import subprocess
+
+from sqlalchemy import Table, Column, Integer, Float, String, Text, MetaData, Index, select, and_, desc
+
+from sqla import SAContext
+from profiler import Profiler
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+bench_results = Table('bench_result', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String, nullable=False),
+    Column('machine', String, nullable=False),
+    Column('commit', String),
+    Column('timestamp', Float, nullable=False),
+    Column('loops', Integer),
+    Column('repeat', Integer),
+    Column('best', Float),
+    Column('mean', Float),
+    Column('median', Float),
+    Column('stdev', Float),
+    Column('stats', Text),
+    Index('ix_bench_result_name', 'name', 'machine', 'timestamp'),
+)
+
+
+def current_commit(path='.'):
+    """Return the git commit of *path*, $BITRUNNER_COMMIT, or None"""
+    commit = os.environ.get('BITRUNNER_COMMIT')
+    if commit:
+        return commit
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=str(path),
+                                         stderr=subprocess.DEVNULL)
+        return output.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def discover(plugin_manager, patterns=None):
+    """Return [(name, callable)] for the bench_* functions of every plugin
+
+    Module level functions and plugin methods named bench_* are collected
+    and named ``<plugin>.<function>``; *patterns* are fnmatch patterns
+    filtering on that name.
+    """
+    benchmarks = []
+    for plug_class in sorted(plugin_manager.get_plugin_entries()):
+        try:
+            plugin = plugin_manager.load_plugin(plug_class)
+        except Exception as err:
+            logger.warning('Benchmarks of {0} not loaded: {1!r}'.format(plug_class, err))
+            continue
+
+        module = sys.modules[type(plugin).__module__]
+        found = dict(inspect.getmembers(module, inspect.isfunction))
+        found.update(inspect.getmembers(plugin, inspect.ismethod))
+
+        for func_name, func in sorted(found.items()):
+            if not func_name.startswith('bench_'):
+                continue
+            name = '{0}.{1}'.format(plugin.name, func_name)
+            if patterns and not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                continue
+            benchmarks.append((name, func))
+
+    return benchmarks
+
+
+class BenchHistory(object):
+    """Benchmark results stored in SQLite through :class:`sqla.SAContext`"""
+
+    def __init__(self, dbPath):
+        self.sa = SAContext(metadata=metadata)
+        self.sa.create_engine('sqlite:///{0}'.format(dbPath))
+        self.sa.create_tables()
+
+    def store(self, name, timing, machine, commit, timestamp=None):
+        row = dict(name=name, machine=machine, commit=commit, timestamp=timestamp or time.time(),
+                   loops=timing.loops, repeat=timing.repeat, best=timing.best, mean=timing.mean,
+                   median=timing.median, stdev=timing.stdev, stats=timing.to_json())
+        with self.sa.engine.begin() as conn:
+            conn.execute(bench_results.insert(), row)
+
+    def baseline(self, name, machine, commit=None, before=None):
+        """Return the latest stored row for *name* on *machine*
+
+        Restricted to *commit* if given, and to rows older than *before*.
+        """
+        conditions = [bench_results.c.name == name, bench_results.c.machine == machine]
+        if commit:
+            conditions.append(bench_results.c.commit == commit)
+        if before:
+            conditions.append(bench_results.c.timestamp < before)
+
+        query = select([bench_results]).where(and_(*conditions)) \
+            .order_by(desc(bench_results.c.timestamp)).limit(1)
+        with self.sa.engine.connect() as conn:
+            return conn.execute(query).first()
+
+
+class BenchRunner(object):
+    """Run plugin benchmarks through :meth:`Profiler.statistical` and flag regressions
+
+    A benchmark regresses when its median per-loop time is more than
+    *threshold* (a fraction) slower than the baseline: the latest stored
+    run for *baseline_commit*, or else the previous stored run, on the
+    same machine.
+    """
+
+    def __init__(self, history=None, threshold=0.1, baseline_commit=None, repeat=20, min_time=0.05,
+                 stdout=None, machine=None, commit=None, store=True):
+        self.history = history
+        self.store = store
+        self.threshold = threshold
+        self.baseline_commit = baseline_commit
+        self.repeat = repeat
+        self.min_time = min_time
+        self.stdout = stdout or sys.stdout
+        self.machine = machine or socket.gethostname()
+        self.commit = commit
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def run(self, benchmarks):
+        """Run *benchmarks*, returning the list of regressed names"""
+        started = time.time()
+        regressions = []
+        for name, func in benchmarks:
+            profiler = Profiler(stdout=self.stdout, count=None, repeat=self.repeat, min_time=self.min_time)
+            try:
+                profiler.statistical(func)()
+            except Exception as err:
+                self.log.exception('Benchmark {0} failed: {1!r}'.format(name, err))
+                regressions.append(name)
+                continue
+
+            timing = profiler.timing
+            timing.name = name
+            if self.history is None:
+                continue
+
+            baseline = self.history.baseline(name, self.machine, self.baseline_commit, before=started)
+            if baseline is not None and baseline.median:
+                change = timing.median / baseline.median - 1
+                self.stdout.write(u"     %+.1f%% vs %s\n" % (change * 100, baseline.commit or 'previous run'))
+                if change > self.threshold:
+                    self.log.error('Benchmark {0} regressed {1:+.1%} (threshold {2:.1%})'.format(
+                        name, change, self.threshold))
+                    regressions.append(name)
+
+            if self.store:
+                self.history.store(name, timing, self.machine, self.commit, timestamp=started)
+
+        return regressions
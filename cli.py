@@ -2,27 +2,29 @@
 
 import os
 import sys
-from pathlib import Path
 
-current_path = Path('.')
+import startup
+startup_profile = startup.StartupProfile.from_argv()
+
+with startup_profile.phase('imports'):
+    from pathlib import Path
+    import logging
+    from logging import StreamHandler
+    import argparse
+    import atexit
+    import copy
 
-import configparser
-import logging
-import logging.handlers
-import logging.config
-from logging import Formatter, StreamHandler
-import subprocess
-import argparse
-import ast
+    # configparser, ast, logging.config and the logging queue are imported
+    # where they are used so --version and --help don't pay for them
 
-import logging_tree 
-import importlib
-import logging
+    from plugin import PluginManager, resolve_result, call_plugin
+    import config
+    import sinks
 
-from plugin import PluginManager
+current_path = Path('.')
 
-if not sys.version_info[0:2] == (3, 6):
-    print("Code written for Python 3.6 or higher")
+if sys.version_info < (3, 8):
+    print("Code written for Python 3.8 or higher")
     sys.exit(1)
 
 __version__ = '0.2'
@@ -66,36 +68,58 @@ class CLI(object):
         self.log.info('Initialize cli')
         self.unknown_args = None
 
-        global_parser = self.global_parser()
-        # pre-parse from global_parser as well as config file and use for commands
-        self.pre_parser = argparse.ArgumentParser(add_help=False, parents=[global_parser])
-        # specifically parsing arguments from associated config file if any
-        #self.options = argparse.Namespace()
-        self.options, self.unknown = self.pre_parser.parse_known_args( )
-
-        self.setup_logger(self.options.logfile, self.options.verbose)
-
-        # then set up the real parser, cloning the initial one
-        self.parser = argparse.ArgumentParser(parents=[self.pre_parser], add_help=True,
-                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-        if self.unknown:
-            if '-h' or '-?' in self.unknown:
-                self.parser.print_help()
-                sys.exit(1)
+        with startup_profile.phase('parse global options'):
+            global_parser = self.global_parser()
+            # pre-parse from global_parser as well as config file and use for commands
+            self.pre_parser = argparse.ArgumentParser(add_help=False, parents=[global_parser])
+            # specifically parsing arguments from associated config file if any
+            #self.options = argparse.Namespace()
+            self.options, self.unknown = self.pre_parser.parse_known_args( )
+
+            # then set up the real parser, cloning the initial one
+            self.parser = argparse.ArgumentParser(parents=[self.pre_parser], add_help=True,
+                                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+        # global help needs no logging, configs or plugins; help for a
+        # plugin or command is printed by its subparser in pre_execute
+        asked_help = any(arg in ('-h', '-?', '--help') for arg in self.unknown)
+        if asked_help and all(arg.startswith('-') for arg in self.unknown):
+            self.parser.print_help()
+            sys.exit(1)
+
+        with startup_profile.phase('setup logging'):
+            self.setup_logger(self.options.logfile, self.options.verbose)
+
+        if self.unknown and not asked_help:
             self.log.warn('Not parsing unknown arguments: {!s}'.format(self.unknown))
 
+        # merged config values and sections, also available as self.settings
+        self.config_values = {}
+        self.config_sections = {}
+        cache_path = None
+        if not self.options.no_config_cache:
+            cache_path = current_path.absolute().joinpath('.{0}.config.cache'.format(self.name))
+        self.config_cache = config.ConfigCache(cache_path)
 
-        # check for application configs and parse
+        # check for application and user configs and parse
         app_config = current_path.absolute().joinpath('{0}.conf'.format(self.name))
-        self.read_config(app_config)
+        self.read_configs([app_config, self.options.config])
+
+        with startup_profile.phase('setup plugins'):
+            self.plugin_manager = PluginManager(self.options)
+            self.setup_plugins()
+
+        with startup_profile.phase('setup commands'):
+            self.setup_commands()
 
-        # check for user config parameter and parse
-        if self.options.config:
-            self.read_config(self.options.config)
+        self.settings = config.make_settings(self.config_values)
+        self.plugin_manager.settings = self.settings
 
-        self.plugin_manager = PluginManager(self.options)
+        # --output sinks, opened on first use and closed when execute returns
+        self.sinks = sinks.SinkCache()
 
-        self.setup_plugins()
+        # options as they stand before any subcommand is parsed
+        self.defaults = copy.copy(self.options)
         self.log.debug('Current Params: {!s}'.format(self.options))
         self.log.info('Complete CLI initialization')
 
@@ -109,15 +133,48 @@ class CLI(object):
         parser.add_argument('--config', help='Parse a local configuration file.')
         parser.add_argument('--version', action='version', version='%(prog)s {!s}'.format(__version__))
 
-        parser.add_argument('--logfile', default=default_logfile, action='store', help='Log to file')
+        parser.add_argument('--logfile', action='store',
+                            help='Also log to this file, rotated by size (e.g. {0})'.format(default_logfile))
+        parser.add_argument('--log-max-bytes', type=int, default=10 * 1024 * 1024,
+                            help='Rotate the log file once it reaches this size')
+        parser.add_argument('--log-backups', type=int, default=5, help='Rotated log files to keep')
+        parser.add_argument('--log-queue-size', type=int, default=config.LOG_QUEUE_SIZE,
+                            help='Log records buffered for the log writer thread')
+        parser.add_argument('--log-full', choices=config.LOG_FULL_POLICIES, default=config.LOG_FULL_POLICIES[0],
+                            help='Drop records or block the caller when the log queue is full')
         parser.add_argument('-v', '--verbose', default=0, action='count', help='Raise the verbosity')
         parser.add_argument('--profile', action='store_true', help='Profile application')
+        parser.add_argument('--profile-interval', type=float, default=0.005,
+                            help='Seconds between profiler stack samples')
+        parser.add_argument('--profile-output', help='Path prefix for the .pstats and .collapsed profiles')
         parser.add_argument('--debug', action='store_true', help='Debug')
+        parser.add_argument('--batch', metavar='FILE',
+                            help='Run the plugin invocation on each line of FILE (- for stdin), '
+                                 'writing JSON Lines results to stdout')
+        parser.add_argument('--batch-workers', type=int, default=1,
+                            help='Number of batch lines executed concurrently')
+        parser.add_argument('--batch-pool', choices=('thread', 'prefork'), default='thread',
+                            help='Execute batch lines on threads or on pre-forked worker processes')
+        parser.add_argument('--output', default='-',
+                            help='Where records yielded by a plugin go: - (JSON Lines on stdout, '
+                                 'not with --batch), jsonl:PATH, csv:PATH or sqlite:PATH[:TABLE]')
+        parser.add_argument('--output-buffer', type=int, default=10000,
+                            help='Records buffered before a streaming plugin waits for the output')
+        parser.add_argument('--concurrency', type=int, default=100,
+                            help='Operations an async plugin keeps in flight through Plugin.gather')
+        parser.add_argument('--no-plugin-cache', action='store_true',
+                            help='Import every plugin instead of reading the plugin manifest')
+        parser.add_argument('--no-config-cache', action='store_true',
+                            help='Parse every config file instead of reading the compiled config cache')
+        parser.add_argument(startup.FLAG, action='store_true',
+                            help='Report the time spent in imports, config reads and plugin setup')
        
         return parser
 
     def setup_logger(self, logFile=None, verbose=0):
         # reconfigure root logger based on user input unless above flag thrown
+        import logqueue
+
         log = logging.getLogger()
         #TODO: review this....
         #  continue to keep root logger at DEBUG and allow each handler to control its own settings.
@@ -137,52 +194,62 @@ class CLI(object):
         stream_handler.setLevel(level)
         log.addHandler(stream_handler)
 
-        #if logFile:
-        #    file_handler = logging.handlers.RotatingFileHandler(logFile, maxBytes=102400, backupCount=5)
-        #    message_format = '%(asctime)s [%(process)d] %(name)-10s %(levelname)-8s %(message)s'
-        #    date_format = '%Y-%m-%d %H:%M:%S'
-        #    formatter = logging.Formatter(fmt=message_format, datefmt=date_format)
-        #    file_handler.setFormatter(formatter)
-            #Set logging level for file handler
-        #    file_handler.setLevel(logging.INFO)
-        #    log.addHandler(file_handler)
+        self.file_handler = None
+        if logFile:
+            self.file_handler = logqueue.RotatingFileHandler(logFile, maxBytes=self.options.log_max_bytes,
+                                                             backupCount=self.options.log_backups)
+            message_format = '%(asctime)s [%(process)d] %(name)-10s %(levelname)-8s %(message)s'
+            date_format = '%Y-%m-%d %H:%M:%S'
+            self.file_handler.setFormatter(logging.Formatter(fmt=message_format, datefmt=date_format))
+            self.file_handler.setLevel(level)
+            log.addHandler(self.file_handler)
+
+        # handlers only write from the log queue thread, so slow I/O doesn't stall the caller
+        self.log_queue = logqueue.LogQueue(self.options.log_queue_size, self.options.log_full)
+        self.log_queue.start()
+        atexit.register(self.log_queue.stop)
 
 
     def read_config(self, configName=None):
-        try:
-            if not configName:
-                return 
-            
-            _config = configparser.ConfigParser(strict=True)
-            configPath = os.path.join(current_path.absolute(), configName)
-            if os.path.isfile(configPath):
-                _config.read(configPath)
+        self.read_configs([configName])
+
+    def read_configs(self, configNames):
+        '''
+        Apply config files in order through the compiled config cache.
+        '''
+        configPaths = [os.path.join(current_path.absolute(), configName)
+                       for configName in configNames if configName]
+        if not configPaths:
+            return
+
+        with startup_profile.phase('read configs'):
+            compiled = self.config_cache.compile(configPaths)
+
+        for configPath, stamp in zip(compiled.paths, compiled.stamps):
+            if stamp is not None:
                 self.log.info('Added params from config file at {0}'.format(configPath))
-                bools = ['True','true','TRUE','False','false','FALSE','yes','no','YES','NO','Yes','No']
+        for configPath, err in compiled.errors:
+            self.log.error('Config {0!s} failed: {1!r}'.format(configPath, err))
+
+        if compiled.logging:
+            import logging.config
 
-                if _config.has_section('LOGGING'):
-                    log_dict = ast.literal_eval(_config.get('LOGGING', 'conf', raw=True))
+            self.log_queue.stop()
+            try:
+                for log_dict in compiled.logging:
                     logging.config.dictConfig(log_dict)
+                if self.file_handler:
+                    logging.getLogger().addHandler(self.file_handler)
+            finally:
+                self.log_queue.start()
 
-                else:
-                    for sect in _config.sections():
-                        for key, value in _config.items(sect):
-                            if value in bools: 
-                                #config_dict[key] = _config.getboolean(sect, key)
-                                setattr(self.options, key, _config.getboolean(sect, key))
-                            else:
-                                #config_dict[key] = value
-                                setattr(self.options, key, value)
-                    
-                
-                self.log.debug('Namespace {!s}'.format(self.options))
-
-        # If no such file
-        except IOError:
-            self.log.error('No config file found at {0}'.format(configPath))
-
-        except configparser.Error as err:
-            self.log.error('Config {0!s} failed: {1!r}'.format(configName, err))
+        for key, value in compiled.values.items():
+            setattr(self.options, key, value)
+        self.config_values.update(compiled.values)
+        for sect, items in compiled.sections.items():
+            self.config_sections.setdefault(sect, {}).update(items)
+
+        self.log.debug('Namespace {!s}'.format(self.options))
 
 
     def setup_plugins(self):
@@ -191,38 +258,218 @@ class CLI(object):
         '''
         self.subparsers = self.parser.add_subparsers(title='plugins', help='Following plugins are available:')
 
-        plugin_dict = self.plugin_manager.get_plugin_registry()
+        plugin_dict = self.plugin_manager.get_plugin_entries()
 
         if not plugin_dict:
             self.log.warn('No plugins were available!')
             return
 
         else:
-            self.log.info('Plugins: {0!s}'.format(plugin_dict))
+            self.log.info('Plugins: {0!s}'.format(list(plugin_dict.keys())))
+
+        self.read_configs([plugin_entry['config_file'] for plugin_entry in plugin_dict.values()])
 
-        for plugin_class, plugin_module in plugin_dict.items():
+        for plugin_class, plugin_entry in plugin_dict.items():
             try:
-                assert isinstance(plugin_module, object)
-                
-                plugin_class = getattr(plugin_module, plugin_class)
-                plugin = plugin_class()
-                plugin_config_file = plugin.get_config_file()
-                self.log.debug('Added params from plugin file at {0}'.format(plugin_config_file))
+                parser = self.subparsers.add_parser(plugin_entry['name'], help=plugin_entry['help'])
 
-                #plugin_args = {}
-                self.read_config(plugin_config_file)
+                # the plugin module itself is only imported once selected
+                parser.set_defaults(plugin_class=plugin_class)
 
-                parser = self.subparsers.add_parser(plugin.name, help=plugin.__doc__)
+                self.plugin_manager.setup_parser(plugin_class, parser)
+                self.log.info('Plugin Intialized: {0}'.format(plugin_entry['name']))
 
-                parser.set_defaults(execute=plugin.execute)
-                #parser.set_defaults(**plugin_args)
+            except Exception as err:
+                self.log.warn('Plugin Failed To Load: {0} - {1!r}'.format(plugin_class, err))
 
-                plugin.setup(parser)
-                self.log.info('Plugin Intialized: {0}'.format(plugin.name))
 
-            except Exception as err:
-                self.log.warn('Plugin Failed To Load: {0} - {1!r}'.format(plugin.name, err))
 
+    def setup_commands(self):
+        '''
+        Add in the built-in commands
+        '''
+        run_parser = self.subparsers.add_parser('run', help='Run several plugin invocations concurrently')
+        run_parser.add_argument('invocations', nargs='*',
+                                help='Plugin invocations, e.g. "test_plugin -s value"')
+        run_parser.add_argument('--jobs', dest='run_file',
+                                help='JSON file listing plugin invocations and their dependencies')
+        run_parser.add_argument('--workers', type=int, default=4, help='Number of concurrent workers')
+        run_parser.add_argument('--pool', choices=('thread', 'process', 'prefork'), default='thread',
+                                help='Run plugins on a thread pool, a process pool or pre-forked workers')
+        run_parser.add_argument('--timeout', type=float, help='Per-plugin timeout in seconds')
+        run_parser.set_defaults(command='run')
+        self.commands['run'] = self.run
+
+        bench_parser = self.subparsers.add_parser('bench', help='Run plugin bench_* functions and check for regressions')
+        bench_parser.add_argument('patterns', nargs='*', help='Only run benchmarks matching these <plugin>.<bench_name> patterns')
+        bench_parser.add_argument('--history', default='{0}.bench.sqlite3'.format(self.name),
+                                  help='SQLite database of benchmark results')
+        bench_parser.add_argument('--baseline', help='Commit to compare against instead of the previous run')
+        bench_parser.add_argument('--threshold', type=float, default=0.1,
+                                  help='Slowdown (fraction of the baseline median) counted as a regression')
+        bench_parser.add_argument('--repeat', type=int, default=20,
+                                  help='Timed batches per benchmark (p95 needs 20, p99 100)')
+        bench_parser.add_argument('--min-time', type=float, default=0.05, help='Minimum seconds per timed batch')
+        bench_parser.add_argument('--no-store', action='store_true', help='Compare without recording the results')
+        bench_parser.set_defaults(command='bench')
+        self.commands['bench'] = self.bench
+
+        serve_parser = self.subparsers.add_parser('serve', help='Serve invocations from client.py over a Unix socket')
+        serve_parser.add_argument('--socket', default='{0}.sock'.format(self.name),
+                                  help='Path of the Unix socket to listen on')
+        serve_parser.add_argument('--max-children', type=int, default=40,
+                                  help='Invocations served at the same time')
+        serve_parser.set_defaults(command='serve')
+        self.commands['serve'] = self.serve
+
+        reach_parser = self.subparsers.add_parser('reach', help='Check which [SERVICE] ports of the targets accept connections')
+        reach_parser.add_argument('targets', nargs='*', help='Host names or addresses to check')
+        reach_parser.add_argument('--targets-file', help='File with one target per line (- for stdin)')
+        reach_parser.add_argument('--services', help='Comma separated [SERVICE] names to check (default all)')
+        reach_parser.add_argument('--ports', help='Extra ports to check, e.g. 22,8000-8010')
+        reach_parser.add_argument('--timeout', type=float, default=1.0, help='Seconds allowed per connect')
+        reach_parser.add_argument('--open-only', action='store_true', help='Only write results for open ports')
+        reach_parser.set_defaults(command='reach')
+        self.commands['reach'] = self.reach
+
+
+    def parse_invocation(self, argv):
+        '''
+        Parse a single plugin invocation into its own options namespace.
+        '''
+        options = self.parser.parse_args(argv, namespace=copy.copy(self.defaults))
+        if not hasattr(options, 'plugin_class'):
+            raise Abort('Not a plugin invocation: {0!r}'.format(argv))
+        return options
+
+
+    def run(self, params):
+        '''
+        Execute the plugin invocations given to the run command concurrently.
+        '''
+        import runner
+
+        try:
+            jobs = runner.load_jobs(params.run_file, params.invocations)
+        except (IOError, ValueError) as err:
+            self.log.error('Run failed to load jobs: {0!r}'.format(err))
+            return 1
+
+        if not jobs:
+            self.log.error('Run has no plugin invocations')
+            return 1
+
+        job_runner = runner.Runner(self, workers=params.workers, pool=params.pool, timeout=params.timeout)
+        return job_runner.run(jobs)
+
+
+    def batch(self, params):
+        '''
+        Execute the invocations listed one per line in the batch file.
+        '''
+        import runner
+
+        plugin_pool = None
+        if params.batch_pool == 'prefork':
+            from pool import PluginPool
+            plugin_pool = PluginPool(self.plugin_manager, workers=params.batch_workers)
+
+        batch_runner = runner.BatchRunner(self, workers=params.batch_workers, plugin_pool=plugin_pool)
+        try:
+            if params.batch == '-':
+                return batch_runner.run(runner.read_batch(sys.stdin))
+
+            with open(params.batch, 'r') as fp:
+                return batch_runner.run(runner.read_batch(fp))
+        except IOError as err:
+            self.log.error('Batch failed to read {0}: {1!r}'.format(params.batch, err))
+            return 1
+        finally:
+            if plugin_pool is not None:
+                plugin_pool.shutdown()
+
+
+    def bench(self, params):
+        '''
+        Run the bench_* functions of the available plugins, returning 1 on any regression.
+        '''
+        import bench
+
+        benchmarks = bench.discover(self.plugin_manager, params.patterns)
+        if not benchmarks:
+            self.log.error('No benchmarks found')
+            return 1
+
+        bench_runner = bench.BenchRunner(bench.BenchHistory(params.history), threshold=params.threshold,
+                                         baseline_commit=params.baseline, repeat=params.repeat,
+                                         min_time=params.min_time, commit=bench.current_commit(current_path),
+                                         store=not params.no_store)
+        regressions = bench_runner.run(benchmarks)
+        if regressions:
+            self.log.error('Benchmark regressions: {0}'.format(', '.join(regressions)))
+            return 1
+        return 0
+
+
+    def serve(self, params):
+        '''
+        Keep this CLI and its plugins resident, serving invocations sent by client.py.
+        '''
+        import server
+
+        try:
+            return server.serve(self, params.socket, params.max_children)
+        except OSError as err:
+            self.log.error('Serve failed: {0!r}'.format(err))
+            return 1
+
+
+    def reach(self, params):
+        '''
+        Connect to each target on each [SERVICE] port, writing results as JSON Lines.
+        '''
+        import contextlib
+        import itertools
+        import reach
+
+        services = reach.service_ports(self.config_sections)
+        if params.services:
+            names = [name.strip() for name in params.services.split(',')]
+            unknown = [name for name in names if name not in services]
+            if unknown:
+                self.log.error('Unknown services {0!r}, configured: {1!r}'.format(unknown, sorted(services)))
+                return 1
+            services = dict((name, services[name]) for name in names)
+        if params.ports:
+            try:
+                services['ports'] = reach.parse_ports(params.ports)
+            except ValueError as err:
+                self.log.error('Bad --ports: {0}'.format(err))
+                return 1
+
+        if not services:
+            self.log.error('No [SERVICE] ports configured')
+            return 1
+
+        with contextlib.ExitStack() as stack:
+            targets = iter(params.targets)
+            if params.targets_file:
+                if params.targets_file == '-':
+                    fp = sys.stdin
+                else:
+                    try:
+                        fp = stack.enter_context(open(params.targets_file, 'r'))
+                    except (IOError, OSError) as err:
+                        self.log.error('Reach failed to read {0}: {1!r}'.format(params.targets_file, err))
+                        return 1
+                lines = (line.strip() for line in fp)
+                targets = itertools.chain(targets, (line for line in lines if line and not line.startswith('#')))
+
+            engine = reach.Reachability(services, concurrency=params.concurrency, timeout=params.timeout)
+            counts = resolve_result(engine.write(targets, open_only=params.open_only))
+
+        self.log.info('Reach results: {0!r}'.format(counts))
+        return 0
 
 
     def pre_execute(self):
@@ -244,6 +491,31 @@ class CLI(object):
             raise Abort(err)
 
 
+    def profile_execute(self, plugin):
+        '''
+        Execute a plugin under the sampling profiler, writing pstats and collapsed stacks.
+        '''
+        from profiler import SamplingProfiler
+
+        sampler = SamplingProfiler(interval=self.options.profile_interval)
+        output = self.options.profile_output or '{0}.{1}'.format(self.name, plugin.name)
+        try:
+            return sampler.runcall(self.call_plugin, plugin, self.options)
+        finally:
+            sampler.dump_stats('{0}.pstats'.format(output))
+            sampler.dump_collapsed('{0}.collapsed'.format(output))
+            self.log.info('Profile of {0} ({1} samples) written to {2}.pstats/.collapsed'.format(
+                plugin.name, sum(sampler.samples.values()), output))
+
+
+    def call_plugin(self, plugin, options):
+        '''
+        Execute a plugin, streaming the records of a generator to its --output,
+        opened once per run and shared by every invocation.
+        '''
+        return call_plugin(plugin, options, self.sinks)
+
+
     def post_execute(self, returned):
         ''' Clean up after the application.
         '''
@@ -268,15 +540,26 @@ class CLI(object):
         Executes pre_execute and post_execute as well.
         '''
         try:
-            if hasattr(self.options, 'execute'):
-                execute_method = getattr(self.options, 'execute')
-                self.log.debug('Execute attribute exists: {0}({1})'.format(execute_method,type(execute_method)))
+            self.pre_execute()
+
+            if self.options.batch:
+                returned = self.batch(self.options)
 
-                self.pre_execute()
+            elif hasattr(self.options, 'command'):
+                command = self.commands[self.options.command]
+                self.log.info('[*] Command: {0}'.format(self.options))
+                returned = command(self.options)
+
+            elif hasattr(self.options, 'plugin_class'):
+                plugin = self.plugin_manager.prepare_plugin(self.options.plugin_class)
+                self.log.debug('Execute plugin: {0}'.format(plugin))
                 self.log.info('[*] Execute: {0}'.format(self.options))
 
                 try:
-                    returned = execute_method.im_self.execute(self.options)
+                    if self.options.profile:
+                        returned = self.profile_execute(plugin)
+                    else:
+                        returned = self.call_plugin(plugin, self.options)
 
                 except Exception as err:
                     self.log.exception('Execute method execution failure: {0}'.format(err))
@@ -309,12 +592,16 @@ class CLI(object):
         except Exception as err:
             logger.exception('Exception occurred : {0!r}'.format(err))
 
+        finally:
+            self.sinks.close()
+
 
 if __name__ == '__main__':
     
     #print('logging tree debug: {0}'.format(logging_tree.printout()))
 
+    atexit.register(startup_profile.report)
     c = CLI()
-    c.execute()
+    sys.exit(c.execute())
 
     #print('logging tree debug: {0}'.format(logging_tree.printout()))
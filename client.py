@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*
+'''Thin client for ``bitrunner serve``.
+
+Usage: python client.py [--socket PATH] <bitrunner arguments>
+
+Hands the arguments, environment, working directory and stdio of this
+process to the daemon listening on the socket ($BITRUNNER_SOCKET, or
+bitrunner.sock in the working directory) and exits with the status of the
+invocation. Without a daemon the arguments are run by cli.py directly.
+Only standard library modules that start quickly are imported here.
+'''
+import os
+import sys
+import json
+import array
+import socket
+import struct
+
+# request: 4 byte body length sent along with the client's stdin/stdout/stderr
+# descriptors, then a JSON body of argv, env and cwd; reply: 4 byte exit status
+HEADER = struct.Struct('!I')
+STATUS = struct.Struct('!i')
+
+# sent by the client when it is interrupted
+INTERRUPT = b'I'
+
+DEFAULT_SOCKET = 'bitrunner.sock'
+
+
+def send_request(sock, argv, env=None, cwd=None, fds=(0, 1, 2)):
+    body = json.dumps({'argv': list(argv), 'env': dict(os.environ if env is None else env),
+                       'cwd': cwd or os.getcwd()}).encode('utf-8')
+    sock.sendmsg([HEADER.pack(len(body))],
+                 [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+    sock.sendall(body)
+
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError('Connection closed after {0} of {1} bytes'.format(len(data), size))
+        data += chunk
+    return data
+
+
+def connect(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def call(sock, argv):
+    '''Run *argv* on the daemon connected to *sock* and return its exit status.'''
+    send_request(sock, argv)
+    while True:
+        try:
+            status, = STATUS.unpack(recv_exactly(sock, STATUS.size))
+            return status
+        except KeyboardInterrupt:
+            # let the invocation clean up and report its own status
+            sock.sendall(INTERRUPT)
+        except EOFError:
+            sys.stderr.write('bitrunner daemon closed the connection\n')
+            return 1
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    socket_path = os.environ.get('BITRUNNER_SOCKET', DEFAULT_SOCKET)
+    if argv[:1] == ['--socket'] and len(argv) > 1:
+        socket_path, argv = argv[1], argv[2:]
+
+    try:
+        sock = connect(socket_path)
+    except OSError:
+        cli_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+        os.execv(sys.executable, [sys.executable, cli_path] + argv)
+
+    with sock:
+        return call(sock, argv)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*
+import os
+import json
+import logging
+import keyword
+
+logger = logging.getLogger(__name__)
+
+# config values that become booleans, as ConfigParser.getboolean reads them
+BOOLEANS = {
+    'True': True, 'true': True, 'TRUE': True, 'yes': True, 'YES': True, 'Yes': True,
+    'False': False, 'false': False, 'FALSE': False, 'no': False, 'NO': False, 'No': False,
+}
+
+# compiled configs kept in the cache file, most recently used last
+CACHE_ENTRIES = 16
+
+# log queue defaults, here so the CLI's option parser doesn't have to import logqueue
+LOG_QUEUE_SIZE = 10000
+LOG_FULL_POLICIES = ('drop', 'block')
+
+
+class Settings(object):
+    '''Resolved config values as attributes.
+
+    Each distinct set of keys gets its own subclass with matching
+    ``__slots__`` (see :func:`settings_class`), so lookups are plain slot
+    reads. Keys that aren't identifiers are only available through
+    :meth:`get`.
+    '''
+    __slots__ = ('_extra',)
+
+    def get(self, name, default=None):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            return self._extra.get(name, default)
+
+    def as_dict(self):
+        values = dict(self._extra)
+        for name in type(self).__slots__:
+            values[name] = getattr(self, name)
+        return values
+
+    def __repr__(self):
+        return 'Settings({0!r})'.format(self.as_dict())
+
+
+_settings_classes = {}
+
+def settings_class(names):
+    '''Return the Settings subclass with a slot for each of *names*.'''
+    names = tuple(sorted(names))
+    klass = _settings_classes.get(names)
+    if klass is None:
+        klass = _settings_classes[names] = type('Settings', (Settings,), {'__slots__': names})
+    return klass
+
+
+_reserved = frozenset(dir(Settings))
+
+def make_settings(values):
+    names = [name for name in values
+             if name.isidentifier() and not keyword.iskeyword(name) and name not in _reserved]
+    settings = settings_class(names)()
+    settings._extra = {}
+    for name, value in values.items():
+        if name in names:
+            setattr(settings, name, value)
+        else:
+            settings._extra[name] = value
+    return settings
+
+
+def file_stamp(path):
+    '''Return [mtime_ns, size] of a config file, or None if it doesn't exist.'''
+    try:
+        st = os.stat(str(path))
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def compile_file(path):
+    '''Parse one config file into its values, sections and logging config.
+
+    A file with a ``[LOGGING]`` section only contributes that logging
+    config and its sections, not option values.
+    '''
+    import configparser
+
+    compiled = {'values': {}, 'sections': {}, 'logging': None}
+    parser = configparser.ConfigParser(strict=True)
+    parser.read(str(path))
+
+    for sect in parser.sections():
+        if sect == 'LOGGING':
+            continue
+        compiled['sections'][sect] = dict(parser.items(sect))
+    if parser.defaults():
+        compiled['sections'][parser.default_section] = dict(parser.items(parser.default_section))
+
+    if parser.has_section('LOGGING'):
+        import ast
+        compiled['logging'] = ast.literal_eval(parser.get('LOGGING', 'conf', raw=True))
+    else:
+        for sect in parser.sections():
+            for key, value in compiled['sections'][sect].items():
+                compiled['values'][key] = BOOLEANS.get(value, value)
+
+    return compiled
+
+
+class CompiledConfig(object):
+    '''The merged result of a list of config files, later files winning.'''
+    __slots__ = ('paths', 'stamps', 'values', 'sections', 'logging', 'errors')
+
+    def __init__(self, paths, stamps, values=None, sections=None, logging=None):
+        self.paths = paths
+        self.stamps = stamps
+        self.values = values or {}
+        self.sections = sections or {}
+        self.logging = logging or []
+        self.errors = []
+
+    @classmethod
+    def compile(cls, paths, stamps):
+        '''Parse and merge *paths*; files that fail to parse are left out and listed in errors.'''
+        import configparser
+
+        compiled = cls(paths, stamps)
+        for path, stamp in zip(paths, stamps):
+            if stamp is None:
+                continue
+            try:
+                layer = compile_file(path)
+            except (configparser.Error, ValueError, SyntaxError) as err:
+                compiled.errors.append((path, err))
+                continue
+            compiled.values.update(layer['values'])
+            for sect, items in layer['sections'].items():
+                compiled.sections.setdefault(sect, {}).update(items)
+            if layer['logging'] is not None:
+                compiled.logging.append(layer['logging'])
+        return compiled
+
+    def as_dict(self):
+        return {'stamps': self.stamps, 'values': self.values, 'sections': self.sections,
+                'logging': self.logging}
+
+
+class ConfigCache(object):
+    '''Compiled configs stored in a JSON file.
+
+    An entry is keyed on the list of contributing paths and only reused
+    while every file keeps its mtime and size, so an unchanged set of
+    configs loads without ConfigParser or ``literal_eval``. A compile with
+    errors is never cached.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.log = logging.getLogger(self.__class__.__name__)
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(str(self.path), 'r') as fp:
+                self.entries = json.load(fp)
+        except (IOError, OSError, ValueError) as err:
+            self.log.debug('Config cache not loaded from {0}: {1!r}'.format(self.path, err))
+            self.entries = {}
+
+    def save(self):
+        if not self.dirty or not self.path:
+            return
+
+        while len(self.entries) > CACHE_ENTRIES:
+            del self.entries[next(iter(self.entries))]
+
+        tmp_path = '{0}.tmp'.format(self.path)
+        try:
+            with open(tmp_path, 'w') as fp:
+                json.dump(self.entries, fp)
+            os.replace(tmp_path, str(self.path))
+            self.dirty = False
+        except (IOError, OSError) as err:
+            self.log.warn('Config cache not saved to {0}: {1!r}'.format(self.path, err))
+
+    def compile(self, paths):
+        '''Return the CompiledConfig for *paths*, from the cache when unchanged.'''
+        paths = [str(path) for path in paths if path]
+        stamps = [file_stamp(path) for path in paths]
+        key = json.dumps(paths)
+
+        entry = self.entries.get(key)
+        if entry is not None and entry['stamps'] == stamps:
+            # move to the end so it is evicted last
+            self.entries[key] = self.entries.pop(key)
+            return CompiledConfig(paths, stamps, entry['values'], entry['sections'], entry['logging'])
+
+        compiled = CompiledConfig.compile(paths, stamps)
+        if compiled.errors:
+            return compiled
+
+        self.entries.pop(key, None)
+        self.entries[key] = compiled.as_dict()
+        self.dirty = True
+        self.save()
+        return compiled
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*
+
+import os
+import stat
+import json
+import logging
+import itertools
+from concurrent import futures
+
+from sqlalchemy import Table, Column, Integer, String, Text, MetaData, Index, and_, bindparam
+
+from sqla import SAContext
+import utils
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+file_hashes = Table('file_hash', metadata,
+    Column('device', Integer, primary_key=True, autoincrement=False),
+    Column('inode', Integer, primary_key=True, autoincrement=False),
+    Column('size', Integer, primary_key=True, autoincrement=False),
+    Column('mtime_ns', Integer, primary_key=True, autoincrement=False),
+    Column('path', Text, nullable=False),
+    Column('digests', String, nullable=False),
+    Index('ix_file_hash_inode', 'inode'),
+    Index('ix_file_hash_path', 'path'),
+)
+
+# SQLite's default limit on bound parameters is 999
+BATCH_SIZE = 500
+
+
+def stat_key(filePath):
+    """Return the (device, inode, size, mtime_ns) cache key for a regular file, else None"""
+    try:
+        st = os.stat(filePath)
+    except OSError:
+        return None
+
+    if not stat.S_ISREG(st.st_mode):
+        return None
+
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def batches(items, size=BATCH_SIZE):
+    """Yield lists of up to *size* items, taking them from *items* as needed"""
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+class FileHashCache(object):
+    """Persistent file digests keyed on (device, inode, size, mtime_ns).
+
+    A file whose key is unchanged since it was last hashed is served from
+    the cache, so rescanning a mostly static tree costs one ``stat`` per
+    file plus a batched query. Usage::
+
+        cache = FileHashCache('hashes.sqlite3')
+        for path, digests in cache.hashFiles(utils.walkFiles('/images'), workers=8):
+            ...
+        cache.evict()
+    """
+
+    def __init__(self, dbPath, algorithms=utils.DEFAULT_DIGESTS):
+        self.algorithms = tuple(algorithms)
+        self.sa = SAContext(metadata=metadata)
+        self.sa.create_engine('sqlite:///{0}'.format(dbPath))
+        self.sa.create_tables()
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def lookup(self, paths, algorithms=None):
+        """Bulk lookup of cached digests.
+
+        Returns a dict of path to (key, digests), where *digests* is None
+        when the file is not cached with every requested algorithm and *key*
+        is None when the path is not a regular file.
+        """
+        algorithms = algorithms or self.algorithms
+        keys = dict((path, stat_key(path)) for path in paths)
+        results = dict((path, (key, None)) for path, key in keys.items())
+
+        by_inode = {}
+        for path, key in keys.items():
+            if key is not None:
+                by_inode.setdefault(key[1], []).append(path)
+
+        with self.sa.engine.connect() as conn:
+            for inodes in batches(list(by_inode.keys())):
+                query = file_hashes.select().where(file_hashes.c.inode.in_(inodes))
+                for row in conn.execute(query):
+                    row_key = (row.device, row.inode, row.size, row.mtime_ns)
+                    for path in by_inode[row.inode]:
+                        if keys[path] != row_key:
+                            continue
+                        digests = json.loads(row.digests)
+                        if all(algorithm in digests for algorithm in algorithms):
+                            results[path] = (row_key, digests)
+
+        return results
+
+    def store(self, entries):
+        """Store (path, key, digests) entries, replacing older rows for the same paths"""
+        rows = [dict(device=key[0], inode=key[1], size=key[2], mtime_ns=key[3],
+                     path=path, digests=json.dumps(digests, sort_keys=True))
+                for path, key, digests in entries if key is not None and digests]
+        if not rows:
+            return
+
+        with self.sa.engine.begin() as conn:
+            for batch in batches(rows):
+                conn.execute(file_hashes.delete().where(
+                    file_hashes.c.path.in_([row['path'] for row in batch])))
+                conn.execute(file_hashes.insert().prefix_with('OR REPLACE'), batch)
+
+    def hashFiles(self, paths, algorithms=None, workers=None, chunkSize=utils.HASH_CHUNK_SIZE):
+        """Yield (path, digests) for *paths* in order, hashing only files missing from the cache.
+
+        *paths* is consumed lazily, a chunk at a time. Misses are hashed on
+        one process pool of *workers* processes for the whole call (or in
+        this process when *workers* is 0) and written back in one
+        transaction per batch before they are yielded.
+        """
+        algorithms = tuple(algorithms or self.algorithms)
+        pool = None
+        try:
+            for chunk in batches(paths, BATCH_SIZE * 4):
+                cached = self.lookup(chunk, algorithms)
+                misses = [path for path in chunk
+                          if cached[path][1] is None and cached[path][0] is not None]
+
+                if not misses:
+                    hashed = []
+                elif workers == 0:
+                    hashed = (utils._hashFileEntry(path, algorithms, chunkSize) for path in misses)
+                else:
+                    if pool is None:
+                        pool = futures.ProcessPoolExecutor(max_workers=workers)
+                    hashed = utils.hashPaths(misses, algorithms, workers, chunkSize, pool=pool)
+
+                entries = [(path, cached[path][0], digests) for path, digests in hashed]
+                self.store(entries)
+                hashed = dict((path, digests) for path, _, digests in entries)
+
+                for path in chunk:
+                    if path in hashed:
+                        yield path, hashed[path]
+                        continue
+                    digests = cached[path][1]
+                    if digests is not None:
+                        digests = dict((algorithm, digests[algorithm]) for algorithm in algorithms)
+                    yield path, digests
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def hashFile(self, filePath, algorithms=None, chunkSize=utils.HASH_CHUNK_SIZE):
+        return dict(self.hashFiles([filePath], algorithms, workers=0, chunkSize=chunkSize))[filePath]
+
+    def evict(self):
+        """Remove entries for files that no longer exist or have changed.
+
+        Returns the number of rows removed.
+        """
+        stale = []
+        with self.sa.engine.connect() as conn:
+            query = file_hashes.select().with_only_columns([
+                file_hashes.c.device, file_hashes.c.inode, file_hashes.c.size,
+                file_hashes.c.mtime_ns, file_hashes.c.path])
+            for row in conn.execute(query):
+                row_key = (row.device, row.inode, row.size, row.mtime_ns)
+                if stat_key(row.path) != row_key:
+                    stale.append(row_key)
+
+        if stale:
+            query = file_hashes.delete().where(and_(
+                file_hashes.c.device == bindparam('key_device'),
+                file_hashes.c.inode == bindparam('key_inode'),
+                file_hashes.c.size == bindparam('key_size'),
+                file_hashes.c.mtime_ns == bindparam('key_mtime_ns')))
+            with self.sa.engine.begin() as conn:
+                conn.execute(query, [dict(key_device=key[0], key_inode=key[1], key_size=key[2],
+                                          key_mtime_ns=key[3]) for key in stale])
+
+        self.log.info('Evicted {0} stale file hashes'.format(len(stale)))
+        return len(stale)
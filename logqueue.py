@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*
+import os
+import sys
+import queue
+import logging
+import logging.handlers
+import threading
+
+import config
+
+# what a full queue does to the logging call: drop the record or wait for room
+POLICIES = config.LOG_FULL_POLICIES
+
+QUEUE_SIZE = config.LOG_QUEUE_SIZE
+BATCH_SIZE = 512
+
+
+class RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    '''Size rotated log file that tracks its own size.
+
+    The stock handler seeks to the end of the file before every record to
+    check the size, which flushes the stream each time and defeats batched
+    writes.
+    '''
+
+    def _open(self):
+        stream = super(RotatingFileHandler, self)._open()
+        self.written = os.fstat(stream.fileno()).st_size
+        return stream
+
+    def write(self, record):
+        msg = self.format(record) + self.terminator
+        if self.stream is None:
+            self.stream = self._open()
+        if self.maxBytes > 0 and self.written and self.written + len(msg) >= self.maxBytes:
+            self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+        self.stream.write(msg)
+        self.written += len(msg)
+
+    def emit(self, record):
+        try:
+            self.write(record)
+            self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def emit_batch(self, records):
+        '''Write *records* and flush once.'''
+        write_batch(self, records, self.write)
+
+
+def _write_stream(handler):
+    def write(record):
+        handler.stream.write(handler.format(record) + handler.terminator)
+    return write
+
+
+def write_batch(handler, records, write=None):
+    '''Emit *records* through *handler* with a single flush at the end.
+
+    *write* emits one record without flushing; by default records go to the
+    stream of a stock StreamHandler or FileHandler. Other handlers handle
+    each record themselves.
+    '''
+    if write is None:
+        stock = type(handler).emit in (logging.StreamHandler.emit, logging.FileHandler.emit)
+        if not stock or getattr(handler, 'stream', None) is None:
+            for record in records:
+                handler.handle(record)
+            return
+        write = _write_stream(handler)
+
+    handler.acquire()
+    try:
+        for record in records:
+            if not handler.filter(record):
+                continue
+            try:
+                write(record)
+            except RecursionError:
+                raise
+            except Exception:
+                handler.handleError(record)
+        handler.flush()
+    finally:
+        handler.release()
+
+
+class QueuedHandler(logging.handlers.QueueHandler):
+    '''Stands in for *target* on a logger and hands its records to a LogQueue.'''
+
+    def __init__(self, log_queue, target):
+        super(QueuedHandler, self).__init__(None)
+        self.log_queue = log_queue
+        self.target = target
+        # records below the target's level never reach the queue
+        self.setLevel(target.level)
+
+    def enqueue(self, record):
+        self.log_queue.put(self.target, record)
+
+
+class LogQueue(object):
+    '''Moves every handler configured on the logging tree behind one queue.
+
+    :meth:`start` replaces each handler found on the root and named loggers
+    with a :class:`QueuedHandler`, so the logging call only formats the
+    message and enqueues it. A single thread writes the records to the real
+    handlers in batches of up to *batch_size*, flushing each handler once
+    per batch. When the queue is full the ``drop`` policy discards the
+    record and counts it in :attr:`dropped`, reported through the handlers
+    as soon as there is room; ``block`` waits instead.
+
+    :meth:`stop` drains the queue and puts the real handlers back, and must
+    be called before the logging tree is reconfigured.
+    '''
+
+    def __init__(self, queue_size=QUEUE_SIZE, policy='drop', batch_size=BATCH_SIZE):
+        if policy not in POLICIES:
+            raise ValueError('Unknown log queue policy {0!r}'.format(policy))
+        self.queue_size = queue_size
+        self.block = policy == 'block'
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.reported = 0
+        self.queue = queue.Queue(queue_size)
+        self.installed = []
+        self._thread = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def put(self, target, record):
+        if self.block:
+            self.queue.put((target, record))
+            return
+        try:
+            self.queue.put_nowait((target, record))
+        except queue.Full:
+            self.dropped += 1
+
+    def loggers(self):
+        manager = logging.Logger.manager
+        found = [logging.getLogger()]
+        found.extend(logger for logger in list(manager.loggerDict.values())
+                     if isinstance(logger, logging.Logger))
+        return found
+
+    def install(self):
+        proxies = {}
+        for logger in self.loggers():
+            for ndx, handler in enumerate(list(logger.handlers)):
+                if isinstance(handler, (QueuedHandler, logging.handlers.QueueHandler)):
+                    continue
+                proxy = proxies.get(id(handler))
+                if proxy is None:
+                    proxy = proxies[id(handler)] = QueuedHandler(self, handler)
+                logger.handlers[ndx] = proxy
+                self.installed.append((logger, proxy))
+
+    def uninstall(self):
+        for logger, proxy in self.installed:
+            handlers = logger.handlers
+            if proxy in handlers:
+                handlers[handlers.index(proxy)] = proxy.target
+        self.installed = []
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.install()
+        self._thread = threading.Thread(target=self._monitor, name='LogQueue')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Write out every queued record and restore the real handlers.'''
+        if self._thread is None:
+            return
+        self.uninstall()
+        self.queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _after_fork(self):
+        # the writer thread doesn't survive fork; restart it with a fresh queue
+        self.queue = queue.Queue(self.queue_size)
+        if self._thread is not None:
+            self._thread = threading.Thread(target=self._monitor, name='LogQueue')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _monitor(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                running = False
+                batch = batch[:batch.index(None)]
+            self.write(batch)
+
+    def write(self, batch):
+        targets = {}
+        records = {}
+        for target, record in batch:
+            targets[id(target)] = target
+            records.setdefault(id(target), []).append(record)
+
+        if self.dropped > self.reported:
+            dropped, self.reported = self.dropped - self.reported, self.dropped
+            notice = logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': 'Log queue full, dropped {0} records'.format(dropped)})
+            for key in records:
+                records[key].append(notice)
+
+        # each handler writes its share of the batch and flushes once
+        for key, target in targets.items():
+            try:
+                emit_batch = getattr(target, 'emit_batch', None)
+                if emit_batch is not None:
+                    emit_batch(records[key])
+                else:
+                    write_batch(target, records[key])
+            except Exception as err:
+                sys.stderr.write('Log handler {0!r} failed: {1!r}\n'.format(target, err))
@@ -1,16 +1,17 @@
 # -*- coding: utf-8 -*
 import os
 import sys
+import types
 from pathlib import Path
 
 current_path = Path('.')
 
-import configparser
-import subprocess
 import argparse
 
 import importlib
 import logging
+import json
+import threading
 
 
 logger = logging.getLogger(__name__)
@@ -55,9 +56,116 @@ class PluginImportError(Error):
 
 
 
+# awaitables a plugin keeps in flight through Plugin.gather by default (--concurrency)
+DEFAULT_CONCURRENCY = 100
+
+
+def run_coroutine(coro):
+    """Run *coro* to completion on a new event loop.
+
+    When called from the main thread, Ctrl-C cancels the coroutine so its
+    cleanup runs, then raises KeyboardInterrupt; a second Ctrl-C interrupts
+    at once.
+    """
+    import asyncio
+    import signal
+    import threading
+
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(coro)
+    interrupted = []
+
+    def interrupt():
+        interrupted.append(True)
+        task.cancel()
+        loop.remove_signal_handler(signal.SIGINT)
+
+    handle_sigint = threading.current_thread() is threading.main_thread()
+    if handle_sigint:
+        loop.add_signal_handler(signal.SIGINT, interrupt)
+
+    try:
+        try:
+            result = loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            if interrupted:
+                raise KeyboardInterrupt()
+            raise
+        if interrupted:
+            raise KeyboardInterrupt()
+        return result
+
+    finally:
+        if handle_sigint:
+            loop.remove_signal_handler(signal.SIGINT)
+        pending = asyncio.all_tasks(loop)
+        if pending:
+            for pending_task in pending:
+                pending_task.cancel()
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+def resolve_result(returned):
+    """Return what a plugin method returned, running it first if it was a coroutine"""
+    if hasattr(returned, '__await__'):
+        return run_coroutine(returned)
+    return returned
+
+
+def is_stream(returned):
+    """True if a plugin returned a generator or async generator of records"""
+    return isinstance(returned, (types.GeneratorType, types.AsyncGeneratorType))
+
+
+def call_plugin(plugin, options, sink_cache=None):
+    """Execute *plugin* with *options* and return what it returned
+
+    An async execute is run to completion on its own event loop. Records
+    yielded by a generator or async generator are streamed to the
+    ``options.output`` sink of *sink_cache* (default
+    :data:`sinks.worker_sinks`, for pool workers) and 0 is returned. An
+    output of None means stdout is taken, so streaming is an error.
+    """
+    plugin.concurrency = options.concurrency
+    returned = plugin.execute(options)
+    if not is_stream(returned):
+        return resolve_result(returned)
+
+    import sinks
+
+    if options.output is None:
+        getattr(returned, 'close', lambda: None)()
+        raise ValueError('Records of {0} need an --output other than stdout here'.format(plugin.name))
+    sink = (sink_cache or sinks.worker_sinks).open(options.output)
+    sinks.stream_results(returned, sink, plugin.name, options.output_buffer)
+    return 0
+
+
+def setup_plugin(plugin, parser):
+    """Call *plugin*'s setup with *parser*, which must not be a coroutine function"""
+    returned = plugin.setup(parser)
+    if hasattr(returned, '__await__'):
+        getattr(returned, 'close', lambda: None)()
+        raise PluginImportError(plugin.name, 'setup must not be async; '
+                                'create event loop bound resources in execute')
+    return returned
+
+
 class Plugin(object):
     """ Plugin help information for this command...
+
+    ``execute`` may be a coroutine function; each invocation then runs it
+    on an event loop of its own. ``setup`` must stay synchronous: it runs
+    when the parser is built (or not until just before execute when the
+    arguments come from the manifest), never on the loop execute gets, so
+    sessions, connections and the like belong in execute.
     """
+    # config.Settings of the merged config values, set when the plugin is loaded
+    settings = None
+    # default limit for gather, set from --concurrency before execute
+    concurrency = DEFAULT_CONCURRENCY
 
     def __init__(self, name, *args, **kwargs):
         self.name = name
@@ -72,19 +180,164 @@ class Plugin(object):
         return self.__doc__
 
     def setup(self, parser):
-        """called before the plugin is asked to do anything"""
+        """called before the plugin is asked to do anything
+
+        Called once per process on the instance that executes. When the
+        plugin's arguments came from the manifest, *parser* is a throwaway
+        parser, so setup still runs before execute.
+        """
         raise NotImplementedError
 
     def execute(self, params):
         """ execute plugin code """
         raise NotImplementedError
 
+    async def gather(self, aws, limit=None, return_exceptions=False):
+        """Await *aws*, at most *limit* (default self.concurrency) at a time.
+
+        Results are returned in the order of *aws*. Coroutines are taken from
+        *aws* only as slots free up, so it can be a generator over any number
+        of targets. Unless *return_exceptions* is set, the first exception
+        cancels the rest and is raised.
+        """
+        import asyncio
+
+        results = {}
+        pending = enumerate(aws)
+
+        async def worker():
+            for ndx, aw in pending:
+                try:
+                    results[ndx] = await aw
+                except Exception as err:
+                    if not return_exceptions:
+                        raise
+                    results[ndx] = err
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(limit or self.concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
+
+        return [results[ndx] for ndx in range(len(results))]
+
 
 
 
+# argparse ``type`` callables that can be stored in the manifest by name
+ARGUMENT_TYPES = {'int': int, 'float': float, 'str': str}
+
+
+class ArgumentRecorder(object):
+    """ Stands in for a subparser during Plugin.setup and records the calls
+    made to it so they can be replayed later without importing the plugin.
+    """
+    recorded = ('add_argument', 'set_defaults')
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.calls = []
+        self.cacheable = True
+
+    def __getattr__(self, attr):
+        if attr in type(self).recorded:
+            def record(*args, **kwargs):
+                self.calls.append([attr, list(args), self.encode(kwargs)])
+                return getattr(self.parser, attr)(*args, **kwargs)
+            return record
+
+        # groups, nested subparsers, ... can't be replayed from the manifest
+        self.cacheable = False
+        return getattr(self.parser, attr)
+
+    def encode(self, kwargs):
+        encoded = dict(kwargs)
+        arg_type = encoded.get('type')
+        if arg_type is not None:
+            encoded['type'] = getattr(arg_type, '__name__', None)
+            if encoded['type'] not in ARGUMENT_TYPES:
+                self.cacheable = False
+
+        try:
+            json.dumps(encoded)
+        except (TypeError, ValueError):
+            self.cacheable = False
+
+        return encoded
+
+
+class PluginManifest(object):
+    """ On-disk cache of plugin metadata (name, help, argument spec, config file)
+    keyed on each plugin file's path, mtime and size.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}
+        self.dirty = False
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.load()
+
+    def load(self):
+        try:
+            with self.path.open('r') as fp:
+                self.entries = json.load(fp)
+        except (IOError, OSError, ValueError) as err:
+            self.log.debug('Plugin manifest not loaded from {0}: {1!r}'.format(self.path, err))
+            self.entries = {}
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        try:
+            with tmp_path.open('w') as fp:
+                json.dump(self.entries, fp, indent=1, sort_keys=True)
+            os.replace(str(tmp_path), str(self.path))
+            self.dirty = False
+        except (IOError, OSError) as err:
+            self.log.warn('Plugin manifest not saved to {0}: {1!r}'.format(self.path, err))
+
+    def lookup(self, plug_path):
+        """Return the cached entry for *plug_path* if the file is unchanged"""
+        entry = self.entries.get(str(plug_path))
+        if not entry:
+            return None
+
+        st = plug_path.stat()
+        if entry['mtime'] != st.st_mtime_ns or entry['size'] != st.st_size:
+            return None
+
+        return entry
+
+    def update(self, plug_path, entry):
+        st = plug_path.stat()
+        entry.update(mtime=st.st_mtime_ns, size=st.st_size)
+        self.entries[str(plug_path)] = entry
+        self.dirty = True
+
+    def prune(self, plug_paths):
+        """Drop entries for plugin files that are no longer present"""
+        live = set(str(p) for p in plug_paths)
+        for key in list(self.entries.keys()):
+            if key not in live:
+                del self.entries[key]
+                self.dirty = True
+
+
 class PluginManager(object):
     _instance = []
     registry = {}
+    instances = {}
+    # plugin classes whose instance has had setup called in this process
+    prepared = set()
+    _prepare_lock = threading.Lock()
+    manifest_name = '.plugins.manifest'
 
     def __init__(self, options):
         self.blacklist = []
@@ -93,11 +346,19 @@ class PluginManager(object):
 
         self.plugin_path =  current_path.absolute()
         self.log = logging.getLogger(self.__class__.__name__)
+
+        self.entries = {}
+        self.settings = None
+        self.manifest = None
+        if not getattr(options, 'no_plugin_cache', False):
+            self.manifest = PluginManifest(self.plugin_path.joinpath(type(self).manifest_name))
+
         self.initialize_plugins()
 
     def initialize_plugins(self):
-      
-        for plug_path in self.plugin_path.glob('*_plugin.py'):
+
+        plug_paths = sorted(self.plugin_path.glob('*_plugin.py'))
+        for plug_path in plug_paths:
             plug_name = plug_path.stem
             self.log.info('Initialize plug_name: {0!s}'.format(plug_name))
 
@@ -107,24 +368,127 @@ class PluginManager(object):
 
             plug_class = self.get_class_name(plug_name)
 
-            try:
-                if plug_path not in sys.path:
-                    sys.path.append(plug_path)
-
-                if plug_name in type(self).registry.keys():
-                    continue
-
-                modObj = importlib.import_module(plug_name, plug_path.absolute())
+            entry = self.manifest.lookup(plug_path) if self.manifest else None
+            if entry:
+                self.log.debug('Plugin {0} loaded from manifest'.format(plug_name))
+                self.entries[plug_class] = entry
+                continue
 
-                self.log.info('Imported module {0} as {1} ({2}) and added to registry'.format(plug_name, modObj, type(modObj)))
-                type(self).registry['{!s}'.format(plug_class)] = modObj
+            try:
+                self.import_plugin(plug_name, plug_path)
+                entry = self.describe_plugin(plug_class, plug_name)
+                self.entries[plug_class] = entry
+                if self.manifest:
+                    self.manifest.update(plug_path, entry)
 
             except PluginImportError as err:
-                self.log.error('PluginImportError:{0}-{1}'.format(dir, err))
+                self.log.error('PluginImportError:{0}-{1}'.format(plug_name, err))
 
             except Exception as err:
                 self.log.exception(err)
 
+        if self.manifest:
+            self.manifest.prune(plug_paths)
+            self.manifest.save()
+
+    def import_plugin(self, plug_name, plug_path=None):
+        """Import a plugin module and add it to the registry"""
+        plug_class = self.get_class_name(plug_name)
+        if plug_class in type(self).registry:
+            return type(self).registry[plug_class]
+
+        plug_path = plug_path or self.plugin_path.joinpath('{0}.py'.format(plug_name))
+        if str(plug_path.parent) not in sys.path:
+            sys.path.append(str(plug_path.parent))
+
+        modObj = importlib.import_module(plug_name)
+
+        self.log.info('Imported module {0} as {1} ({2}) and added to registry'.format(plug_name, modObj, type(modObj)))
+        type(self).registry['{!s}'.format(plug_class)] = modObj
+        return modObj
+
+    def load_plugin(self, plug_class):
+        """Return the plugin instance for *plug_class*, importing it on first use"""
+        if plug_class in type(self).instances:
+            plugin = type(self).instances[plug_class]
+            plugin.settings = self.settings
+            return plugin
+
+        modObj = type(self).registry.get(plug_class)
+        if modObj is None:
+            entry = self.entries.get(plug_class)
+            if entry is None:
+                raise PluginImportError(plug_class, 'not found')
+            modObj = self.import_plugin(entry['module'])
+
+        try:
+            plugin = getattr(modObj, plug_class)()
+        except Exception as err:
+            raise PluginImportError(plug_class, err)
+
+        plugin.settings = self.settings
+        type(self).instances[plug_class] = plugin
+        return plugin
+
+    def prepare_plugin(self, plug_class):
+        """Return the plugin instance for *plug_class* with its setup called
+
+        A subparser built from the manifest never ran setup, so it is called
+        here with a throwaway parser before the plugin first executes.
+        """
+        plugin = self.load_plugin(plug_class)
+        with type(self)._prepare_lock:
+            if plug_class not in type(self).prepared:
+                setup_plugin(plugin, argparse.ArgumentParser(add_help=False))
+                type(self).prepared.add(plug_class)
+        return plugin
+
+    def preload(self):
+        """Import and set up every plugin, e.g. before forking workers
+
+        A plugin that fails is logged and left to fail again when used.
+        """
+        for plug_class in self.get_plugin_entries():
+            try:
+                self.prepare_plugin(plug_class)
+            except Exception as err:
+                logger.warning('Plugin {0} not preloaded: {1!r}'.format(plug_class, err))
+
+    def describe_plugin(self, plug_class, plug_name):
+        """Build the manifest entry for an imported plugin"""
+        plugin = self.load_plugin(plug_class)
+
+        recorder = ArgumentRecorder(argparse.ArgumentParser(add_help=False))
+        setup_plugin(plugin, recorder)
+        type(self).prepared.add(plug_class)
+
+        get_config_file = getattr(plugin, 'get_config_file', None)
+        config_file = get_config_file() if get_config_file else None
+
+        return {
+            'module': plug_name,
+            'name': plugin.name,
+            'help': plugin.__doc__,
+            'config_file': str(config_file) if config_file else None,
+            'arguments': recorder.calls,
+            'cacheable': recorder.cacheable,
+        }
+
+    def setup_parser(self, plug_class, parser):
+        """Populate a plugin's subparser, from the manifest where possible"""
+        entry = self.entries[plug_class]
+        if not entry['cacheable']:
+            setup_plugin(self.load_plugin(plug_class), parser)
+            type(self).prepared.add(plug_class)
+            return
+
+        for method, args, kwargs in entry['arguments']:
+            if kwargs.get('type'):
+                kwargs = dict(kwargs, type=ARGUMENT_TYPES[kwargs['type']])
+            getattr(parser, method)(*args, **kwargs)
+
+    def get_plugin_entries(self):
+        return self.entries
 
     def get_class_name(self, module_name):
         """Return the class name from a plugin name"""
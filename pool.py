@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*
+import os
+import pickle
+import logging
+import multiprocessing
+from concurrent import futures
+
+from plugin import PluginManager, call_plugin
+
+logger = logging.getLogger(__name__)
+
+# results that pickle to at least this many bytes come back through shared memory
+SHARED_THRESHOLD = 1024 * 1024
+
+
+class PickledResult(object):
+    '''A plugin result pickled once by a worker.
+
+    The executor then only has to copy the bytes, instead of pickling the
+    result a second time.
+    '''
+
+    def __init__(self, data, buffers):
+        self.data = data
+        self.buffers = buffers
+
+    def unpack(self):
+        return pickle.loads(self.data, buffers=self.buffers)
+
+    def discard(self):
+        pass
+
+
+class SharedResult(object):
+    '''A pickled plugin result left in a shared memory block by a worker.
+
+    Out-of-band buffers (pickle protocol 5, e.g. numpy arrays) are stored
+    after the pickle stream, so neither the stream nor the buffers pass
+    through the executor's result pipe. The parent owns the block: the
+    worker drops it from its resource tracker, and :meth:`unpack` or
+    :meth:`discard` unlinks it.
+    '''
+
+    def __init__(self, name, size, buffers):
+        self.name = name
+        self.size = size
+        self.buffers = buffers
+
+    @classmethod
+    def pack(cls, returned, threshold=SHARED_THRESHOLD):
+        '''Return *returned* itself if it is a plain value, else a PickledResult or,
+        from *threshold* bytes on, a SharedResult holding it.'''
+        if returned is None or isinstance(returned, (int, float, bool, Exception)):
+            return returned
+
+        buffers = []
+        data = pickle.dumps(returned, protocol=5, buffer_callback=buffers.append)
+        raws = [buffer.raw() for buffer in buffers]
+        total = len(data) + sum(raw.nbytes for raw in raws)
+        if total < threshold:
+            return PickledResult(data, [raw.tobytes() for raw in raws])
+
+        from multiprocessing import shared_memory, resource_tracker
+
+        shm = shared_memory.SharedMemory(create=True, size=total)
+        # otherwise this worker's tracker reports the block as leaked, or
+        # unlinks it, once the worker exits
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        try:
+            offset = len(data)
+            shm.buf[:offset] = data
+            layout = []
+            for raw in raws:
+                shm.buf[offset:offset + raw.nbytes] = raw
+                layout.append((offset, raw.nbytes))
+                offset += raw.nbytes
+        finally:
+            shm.close()
+        return cls(shm.name, len(data), layout)
+
+    def unpack(self):
+        '''Load the result and free the shared memory block.'''
+        from multiprocessing import shared_memory
+
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            buffers = [bytearray(shm.buf[offset:offset + size]) for offset, size in self.buffers]
+            return pickle.loads(shm.buf[:self.size], buffers=buffers)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def discard(self):
+        '''Free the shared memory block without loading the result.'''
+        from multiprocessing import shared_memory
+
+        shm = shared_memory.SharedMemory(name=self.name)
+        shm.close()
+        shm.unlink()
+
+
+def unpack_result(returned):
+    if isinstance(returned, (SharedResult, PickledResult)):
+        return returned.unpack()
+    return returned
+
+
+_threshold = SHARED_THRESHOLD
+
+def _init_worker(threshold):
+    global _threshold
+    _threshold = threshold
+
+
+def _ready():
+    return os.getpid()
+
+
+def _execute(plug_class, options):
+    '''Worker entry point: the plugin instance was created before the fork.'''
+    plugin = PluginManager.instances.get(plug_class)
+    if plugin is None:
+        raise LookupError('Plugin {0} was not loaded before the pool started'.format(plug_class))
+    return SharedResult.pack(call_plugin(plugin, options), _threshold)
+
+
+def terminate_workers(executor):
+    '''Stop the worker processes of a process pool, along with whatever they are running.
+
+    The pool can't be used afterwards.
+    '''
+    terminate = getattr(executor, 'terminate_workers', None)
+    if terminate is not None:
+        # ProcessPoolExecutor on Python 3.14+, PluginPool
+        terminate()
+        return
+
+    for process in list((getattr(executor, '_processes', None) or {}).values()):
+        process.terminate()
+    executor.shutdown(wait=True)
+
+
+class PluginPool(object):
+    '''Pre-forked, reused worker processes executing plugins.
+
+    Every plugin is imported, instantiated and set up before the workers are
+    forked, so workers start with the plugin registry loaded and are reused
+    for every submission; only the options go to the worker. Results that
+    pickle to *threshold* bytes or more come back through
+    ``multiprocessing.shared_memory`` (see :class:`SharedResult`).
+
+    Needs the fork start method, so POSIX only.
+    '''
+
+    def __init__(self, plugin_manager, workers=None, threshold=SHARED_THRESHOLD):
+        self.workers = workers or os.cpu_count()
+        plugin_manager.preload()
+
+        self.executor = futures.ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'),
+                                                    initializer=_init_worker, initargs=(threshold,))
+        # fork every worker now instead of on first use
+        pids = set(future.result() for future in [self.executor.submit(_ready) for _ in range(self.workers)])
+        logger.debug('Forked {0} plugin workers: {1}'.format(len(pids), sorted(pids)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def submit(self, plug_class, options):
+        '''Execute a plugin in a worker, returning a Future of its returned value.'''
+        inner = self.executor.submit(_execute, plug_class, options)
+        outer = futures.Future()
+
+        def done(inner):
+            if outer.cancelled():
+                # nobody wants the result, but its shared memory still has to go
+                if not inner.cancelled() and inner.exception() is None:
+                    returned = inner.result()
+                    if isinstance(returned, (SharedResult, PickledResult)):
+                        returned.discard()
+                return
+            if inner.cancelled():
+                outer.cancel()
+                outer.set_running_or_notify_cancel()
+                return
+            try:
+                outer.set_result(unpack_result(inner.result()))
+            except BaseException as err:
+                outer.set_exception(err)
+
+        inner.add_done_callback(done)
+        outer.add_done_callback(lambda outer: outer.cancelled() and inner.cancel())
+        return outer
+
+    def execute(self, plug_class, options):
+        return self.submit(plug_class, options).result()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def terminate_workers(self):
+        '''Stop the workers, along with whatever they are running; the pool can't be used afterwards.'''
+        terminate_workers(self.executor)
@@ -2,8 +2,17 @@
 
 import pstats
 import sys
-
-__all__ = ["Profiler", "fmtsec"]
+import os
+import gc
+import json
+import itertools
+import statistics
+import marshal
+import signal
+import threading
+from collections import Counter
+
+__all__ = ["Profiler", "SamplingProfiler", "TimingResult", "fmtsec"]
 
 class update_wrapper(object):
     assignments = ('__module__', '__name__', '__doc__')
@@ -58,6 +67,144 @@ def fmtsec(seconds):
     return format % (seconds, prefix)
 
 
+class SamplingProfiler(object):
+    """A low-overhead statistical profiler.
+
+    Instead of tracing every call like :mod:`cProfile`, the running stack
+    is sampled every *interval* seconds and identical stacks are counted.
+    In ``'signal'`` mode a ``SIGPROF`` interval timer samples the main
+    thread on CPU time; in ``'thread'`` mode a background thread samples
+    every other thread's stack on wall-clock time. Signal mode is used when
+    available and started from the main thread, otherwise thread mode.
+
+    Results can be written as a :mod:`pstats` file (times are sample
+    counts times *interval*) or as collapsed stacks for flame graph
+    tools::
+
+        sampler = SamplingProfiler(interval=0.005)
+        sampler.start()
+        run()
+        sampler.stop()
+        sampler.dump_stats('run.pstats')
+        sampler.dump_collapsed('run.collapsed')
+    """
+
+    def __init__(self, interval=0.005, mode=None):
+        self.interval = interval
+        if mode is None:
+            mode = 'signal' if self.signal_available() else 'thread'
+        self.mode = mode
+        self.samples = Counter()
+        self.stats = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self._previous_handler = None
+
+    @staticmethod
+    def signal_available():
+        return hasattr(signal, 'SIGPROF') and \
+            threading.current_thread() is threading.main_thread()
+
+    @staticmethod
+    def stack(frame):
+        """Return the stack of *frame* as code keys, outermost first"""
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+    def _on_signal(self, signum, frame):
+        self.samples[self.stack(frame)] += 1
+
+    def _sample_threads(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.samples[self.stack(frame)] += 1
+
+    def start(self):
+        if self.mode == 'signal':
+            self._previous_handler = signal.signal(signal.SIGPROF, self._on_signal)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        else:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample_threads, name='SamplingProfiler')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self.mode == 'signal':
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        elif self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def runcall(self, func, *args, **kwargs):
+        with self:
+            return func(*args, **kwargs)
+
+    def create_stats(self):
+        """Build :attr:`stats`, a :mod:`pstats` compatible dict, from the samples"""
+        entries = {}
+
+        def entry(key):
+            if key not in entries:
+                entries[key] = [0, 0, 0.0, 0.0, {}]
+            return entries[key]
+
+        for stack, count in self.samples.items():
+            if not stack:
+                continue
+            seconds = count * self.interval
+            entry(stack[-1])[2] += seconds
+
+            # cumulative time counts each function once per stack
+            for key in set(stack):
+                func = entry(key)
+                func[0] += count
+                func[1] += count
+                func[3] += seconds
+
+            for caller, callee in set(zip(stack, stack[1:])):
+                callers = entry(callee)[4]
+                cc, nc, tt, ct = callers.get(caller, (0, 0, 0.0, 0.0))
+                callers[caller] = (cc + count, nc + count, tt, ct + seconds)
+
+        self.stats = dict((key, tuple(value)) for key, value in entries.items())
+
+    def dump_stats(self, filename):
+        """Write a file loadable with ``pstats.Stats(filename)``"""
+        self.create_stats()
+        with open(filename, 'wb') as f:
+            marshal.dump(self.stats, f)
+
+    def collapsed(self):
+        """Yield ``frame;frame;frame count`` lines, outermost frame first"""
+        for stack, count in sorted(self.samples.items()):
+            frames = ['{0}:{1}'.format(os.path.basename(filename), name)
+                      for filename, _, name in stack]
+            yield '{0} {1}'.format(';'.join(frames), count)
+
+    def dump_collapsed(self, filename):
+        with open(filename, 'w') as f:
+            for line in self.collapsed():
+                f.write(line + '\n')
+
+
 class Profiler(object):
     """A profiling tool.
 
@@ -90,16 +237,26 @@ class Profiler(object):
         length = len(biglist)
 
     *count* and *repeat* control the number of iterations the code in
-    question will be run in the :meth:`statistical` profiler.
+    question will be run in the :meth:`statistical` profiler; a *count*
+    of None picks the number of loops automatically so each timed batch
+    lasts at least *min_time* seconds. *warmup* untimed batches are run
+    first, and the garbage collector is disabled while timing unless *gc*
+    is True.
     """
 
-    def __init__(self, stdout=None, anonymous=False, count=1000, repeat=3):
+    def __init__(self, stdout=None, anonymous=False, count=1000, repeat=3,
+                 warmup=1, min_time=0.2, gc=False):
         self.stdout = stdout is None and sys.stdout or stdout
         self.anonymous = anonymous
         self.count = count
         self.repeat = repeat
+        self.warmup = warmup
+        self.min_time = min_time
+        self.gc = gc
         self.stats = None
         self.result = None
+        self.timing = None
+        self.sampler = None
 
     def wrap(self, wrapper, wrapped):
         """Wrap callable *wrapped* with *wrapper*.
@@ -152,15 +309,42 @@ class Profiler(object):
 
         return self.wrap(wrapper, func)
 
-    def statistical(self, func):
-        """Run *func* many times, reporting the best run time.
+    def sampling(self, func, interval=0.005):
+        """Profile *func* with a :class:`SamplingProfiler`.
 
-        This profiling method wraps *func* with a decorator that
-        performs :attr:`repeat` runs, executing *func* :attr:`count`
-        times each run. The profiler will average the execution time for
-        each loop and report the best time on :attr:`stdout`. The result
-        is saved at :attr:`result` -- divide this number by
-        :attr:`count` to determine the average execution time.
+        Unlike :meth:`deterministic`, only periodic stack samples are
+        taken, so the overhead stays low enough for production runs. The
+        report is written to :attr:`stdout` and the profiler is saved to
+        the :attr:`sampler` attribute after the run.
+        """
+        def wrapper(*args, **kwargs):
+            self.stdout.write(u"===> Sampling %s:\n" % func.__name__)
+            self.sampler = SamplingProfiler(interval=interval)
+            try:
+                return self.sampler.runcall(func, *args, **kwargs)
+            finally:
+                self.stats = pstats.Stats(self.sampler, stream=self.stdout)
+                self.stats.strip_dirs().sort_stats('cumulative').print_stats(20)
+
+        return self.wrap(wrapper, func)
+
+    def statistical(self, func):
+        """Run *func* in timed batches, reporting the distribution of run times.
+
+        This profiling method wraps *func* with a decorator that performs
+        :attr:`warmup` untimed batches and then :attr:`repeat` timed
+        batches of :attr:`count` calls each. Only the batch as a whole is
+        timed, so timer overhead doesn't distort very fast functions, and
+        the garbage collector is disabled while timing unless
+        :attr:`gc` is True. If :attr:`count` is None the batch size is
+        chosen like :func:`timeit.Timer.autorange`, so that a batch takes at
+        least :attr:`min_time` seconds.
+
+        The best per-loop time, mean, median, stdev and, given enough
+        batches, percentiles are reported on :attr:`stdout`. The full results are saved as a
+        :class:`TimingResult` at :attr:`timing` (see
+        :meth:`TimingResult.to_json`), and the best batch total at
+        :attr:`result` -- divide it by the loop count for the per-loop time.
 
         This profiler is useful for comparing the speed of equivalent
         implementations of similar algorithms.
@@ -170,25 +354,105 @@ class Profiler(object):
         except ImportError: # pragma: no cover
             from time import time as timer
 
-        def timeit(func, *args, **kwargs):
-            cumulative = 0
-            for i in range(self.count):
+        def batch(loops, *args, **kwargs):
+            it = itertools.repeat(None, loops)
+            gcold = gc.isenabled()
+            if not self.gc:
+                gc.disable()
+            try:
                 start = timer()
-                func(*args, **kwargs)
-                stop = timer()
-                cumulative += stop - start
-
-            return cumulative
-
-        def repeat(func, *args, **kwargs):
-            return [timeit(func, *args, **kwargs) for i in range(self.repeat)]
+                for _ in it:
+                    func(*args, **kwargs)
+                return timer() - start
+            finally:
+                if gcold:
+                    gc.enable()
+
+        def autorange(*args, **kwargs):
+            i = 1
+            while True:
+                for j in 1, 2, 5:
+                    loops = i * j
+                    if batch(loops, *args, **kwargs) >= self.min_time:
+                        return loops
+                i *= 10
 
         def wrapper(*args, **kwargs):
             self.stdout.write(u"===> Profiling %s: " % func.__name__)
-            self.result = min(repeat(func, *args, **kwargs))
+            loops = self.count or autorange(*args, **kwargs)
+            for i in range(self.warmup):
+                batch(loops, *args, **kwargs)
+
+            totals = [batch(loops, *args, **kwargs) for i in range(self.repeat)]
+            self.result = min(totals)
+            self.timing = TimingResult(func.__name__, loops, totals)
             self.stdout.write(u"%d loops, best of %d: %s per loop\n" % (
-                self.count, self.repeat, fmtsec(self.result/self.count)))
+                loops, self.repeat, fmtsec(self.result/loops)))
+            self.stdout.write(u"     mean %s +- %s, median %s" % (
+                fmtsec(self.timing.mean), fmtsec(self.timing.stdev), fmtsec(self.timing.median)))
+            if 95 in self.timing.reported_percentiles():
+                self.stdout.write(u", p95 %s" % fmtsec(self.timing.percentile(95)))
+            self.stdout.write(u"\n")
 
         return self.wrap(wrapper, func)
 
+
+class TimingResult(object):
+    """Per-loop timings from :meth:`Profiler.statistical`.
+
+    *totals* are the run times of each timed batch of *loops* calls;
+    :attr:`timings` are the derived per-loop times in seconds. A
+    percentile is only reported once there are enough batches to tell it
+    apart from the best or worst time (see :meth:`reported_percentiles`),
+    e.g. 20 for p95 and 100 for p99.
+    """
+
+    percentiles = (5, 25, 50, 75, 95, 99)
+
+    def __init__(self, name, loops, totals):
+        self.name = name
+        self.loops = loops
+        self.repeat = len(totals)
+        self.timings = [total / loops for total in totals]
+        self.best = min(self.timings)
+        self.worst = max(self.timings)
+        self.mean = statistics.mean(self.timings)
+        self.median = statistics.median(self.timings)
+        self.stdev = statistics.stdev(self.timings) if len(self.timings) > 1 else 0.0
+
+    def percentile(self, pct):
+        """Return the per-loop time at *pct* (0-100), interpolating linearly"""
+        ordered = sorted(self.timings)
+        rank = (len(ordered) - 1) * pct / 100.0
+        low = int(rank)
+        high = min(low + 1, len(ordered) - 1)
+        return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+    def reported_percentiles(self):
+        """Return the percentiles with at least 100 / min(pct, 100 - pct) batches behind them"""
+        return [pct for pct in self.percentiles
+                if self.repeat * min(pct, 100 - pct) >= 100]
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'loops': self.loops,
+            'repeat': self.repeat,
+            'best': self.best,
+            'worst': self.worst,
+            'mean': self.mean,
+            'median': self.median,
+            'stdev': self.stdev,
+            'percentiles': dict((str(pct), self.percentile(pct)) for pct in self.reported_percentiles()),
+            'timings': self.timings,
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def __repr__(self):
+        return "TimingResult: %s %d loops x %d, median %s" % (
+            self.name, self.loops, self.repeat, fmtsec(self.median))
+
+
 __call__ = Profiler.deterministic
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+SERVICE_SECTION = 'SERVICE'
+
+OPEN, CLOSED, TIMEOUT, ERROR = 'open', 'closed', 'timeout', 'error'
+
+
+def parse_ports(value):
+    '''Parse a port list such as ``"80, 81,8000-8010"`` into a frozenset of ints.'''
+    ports = set()
+    for part in str(value).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        first = int(first)
+        last = int(last) if last else first
+        if not 0 < first <= last <= 65535:
+            raise ValueError('Invalid port range {0!r}'.format(part))
+        ports.update(range(first, last + 1))
+    return frozenset(ports)
+
+
+def service_ports(sections, section=SERVICE_SECTION):
+    '''Return {service: frozenset(ports)} from a [SERVICE] config section.
+
+    *sections* maps section names to {key: value} as in
+    ``CLI.config_sections``. [DEFAULT] values that ConfigParser merges into
+    every section and entries that aren't port lists are skipped.
+    '''
+    defaults = sections.get('DEFAULT', {})
+    services = {}
+    for name, value in sections.get(section, {}).items():
+        if defaults.get(name) == value:
+            continue
+        try:
+            services[name] = parse_ports(value)
+        except ValueError:
+            logger.debug('Skipped {0} = {1!r}: not a port list'.format(name, value))
+    return services
+
+
+def port_services(services):
+    '''Invert {service: ports} into {port: sorted service names}.'''
+    by_port = {}
+    for name, ports in services.items():
+        for port in ports:
+            by_port.setdefault(port, []).append(name)
+    for names in by_port.values():
+        names.sort()
+    return by_port
+
+
+class Reachability(object):
+    '''Check every target x port combination with asyncio TCP connects.
+
+    At most *concurrency* connects are in flight and each is given
+    *timeout* seconds. Host names are resolved once per target and the
+    address is dropped after the target's last port is checked.
+    Combinations are produced lazily and results are yielded as they
+    complete from :meth:`results`, so memory stays bounded however many
+    targets are checked. *connect* can replace ``asyncio.open_connection``,
+    e.g. to run against local stand-ins.
+    '''
+
+    def __init__(self, services, concurrency=100, timeout=1.0, connect=None):
+        self.by_port = port_services(services)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.connect = connect or asyncio.open_connection
+        self.addresses = {}
+        self.pending = {}
+
+    async def resolve(self, host):
+        address = self.addresses.get(host)
+        if address is None:
+            address = self.addresses[host] = asyncio.ensure_future(self._resolve(host))
+        return await address
+
+    async def _resolve(self, host):
+        infos = await asyncio.get_event_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        return infos[0][4][0]
+
+    async def check(self, host, port):
+        '''Return the result dict for one connect to *host*:*port*.'''
+        result = {'host': host, 'port': port, 'services': self.by_port.get(port, [])}
+        started = time.perf_counter()
+        try:
+            address = await self.resolve(host)
+            reader, writer = await asyncio.wait_for(self.connect(address, port), self.timeout)
+            writer.close()
+            result['status'] = OPEN
+        except asyncio.TimeoutError:
+            result['status'] = TIMEOUT
+        except ConnectionRefusedError:
+            result['status'] = CLOSED
+        except OSError as err:
+            result['status'] = ERROR
+            result['error'] = str(err)
+        result['elapsed'] = round(time.perf_counter() - started, 6)
+        return result
+
+    def release(self, host):
+        '''Forget *host*'s address once none of its checks remain.'''
+        self.pending[host] -= 1
+        if not self.pending[host]:
+            del self.pending[host]
+            self.addresses.pop(host, None)
+
+    def combinations(self, targets):
+        ports = sorted(self.by_port)
+        for host in targets:
+            if not ports:
+                continue
+            # counted up front so the address outlives this host's slowest port
+            self.pending[host] = self.pending.get(host, 0) + len(ports)
+            for port in ports:
+                yield host, port
+
+    async def results(self, targets):
+        '''Async generator of result dicts in completion order.'''
+        combinations = self.combinations(targets)
+        queue = asyncio.Queue(self.concurrency)
+
+        async def worker():
+            for host, port in combinations:
+                try:
+                    result = await self.check(host, port)
+                finally:
+                    self.release(host)
+                await queue.put(result)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.concurrency)]
+        done = asyncio.ensure_future(asyncio.gather(*workers))
+        try:
+            while not (done.done() and queue.empty()):
+                getter = asyncio.ensure_future(queue.get())
+                await asyncio.wait([getter, done], return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield getter.result()
+                    while not queue.empty():
+                        yield queue.get_nowait()
+                else:
+                    getter.cancel()
+            done.result()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def write(self, targets, output=None, open_only=False):
+        '''Write each result to *output* as a JSON line, returning counts by status.'''
+        output = output or sys.stdout
+        counts = dict.fromkeys((OPEN, CLOSED, TIMEOUT, ERROR), 0)
+        async for result in self.results(targets):
+            counts[result['status']] += 1
+            if open_only and result['status'] != OPEN:
+                continue
+            output.write(json.dumps(result) + '\n')
+        output.flush()
+        return counts
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*
+import sys
+import re
+import json
+import shlex
+import argparse
+import time
+import importlib
+import logging
+from concurrent import futures
+
+from pool import PluginPool, terminate_workers
+
+logger = logging.getLogger(__name__)
+
+# exit codes reported for jobs that never produced a return value
+TIMEOUT_STATUS = 124
+SKIPPED_STATUS = 125
+
+
+class Job(object):
+    '''A single plugin invocation within a run.
+    '''
+
+    def __init__(self, name, argv, after=None, timeout=None):
+        self.name = name
+        self.argv = shlex.split(argv) if isinstance(argv, str) else list(argv)
+        self.after = list(after or [])
+        self.timeout = timeout
+
+        self.options = None
+        self.status = None
+        self.state = 'pending'
+        self.started = None
+        self.elapsed = None
+
+    def __repr__(self):
+        return 'Job: {0} {1!r} ({2})'.format(self.name, self.argv, self.state)
+
+
+def load_jobs(run_file=None, invocations=None):
+    '''Build jobs from a JSON run file and/or command line invocations.
+
+    The run file holds a list of objects with an ``argv`` (list or string)
+    and optional ``name``, ``after`` (names of jobs that must succeed first)
+    and ``timeout`` keys. Invocations are plain strings such as
+    ``"test_plugin -s value"`` and have no dependencies.
+    '''
+    specs = []
+    if run_file:
+        with open(run_file, 'r') as fp:
+            specs.extend(json.load(fp))
+
+    specs.extend({'argv': invocation} for invocation in invocations or [])
+
+    jobs = []
+    for ndx, spec in enumerate(specs):
+        jobs.append(Job(spec.get('name', str(ndx)), spec['argv'],
+                        after=spec.get('after'), timeout=spec.get('timeout')))
+
+    names = set()
+    for job in jobs:
+        if job.name in names:
+            raise ValueError('Duplicate job name {0!r}'.format(job.name))
+        names.add(job.name)
+
+    for job in jobs:
+        missing = set(job.after) - names
+        if missing:
+            raise ValueError('Job {0!r} depends on unknown jobs {1!r}'.format(job.name, sorted(missing)))
+
+    check_cycles(jobs)
+    return jobs
+
+
+def check_cycles(jobs):
+    '''Raise ValueError if the ``after`` dependencies contain a cycle.'''
+    graph = dict((job.name, job.after) for job in jobs)
+    done = set()
+
+    for name in graph:
+        stack = [(name, iter(graph[name]))]
+        path = set([name])
+        while stack:
+            node, deps = stack[-1]
+            for dep in deps:
+                if dep in path:
+                    raise ValueError('Dependency cycle through job {0!r}'.format(dep))
+                if dep not in done:
+                    stack.append((dep, iter(graph[dep])))
+                    path.add(dep)
+                    break
+            else:
+                stack.pop()
+                path.discard(node)
+                done.add(node)
+
+
+_worker_plugins = {}
+
+def execute_plugin(plugin_dir, module_name, plug_class, options):
+    '''Process pool entry point: import and set up the plugin once per worker and execute it.'''
+    from plugin import call_plugin, setup_plugin
+
+    plugin = _worker_plugins.get(plug_class)
+    if plugin is None:
+        if plugin_dir not in sys.path:
+            sys.path.append(plugin_dir)
+        modObj = importlib.import_module(module_name)
+        plugin = getattr(modObj, plug_class)()
+        setup_plugin(plugin, argparse.ArgumentParser(add_help=False))
+        _worker_plugins[plug_class] = plugin
+
+    return call_plugin(plugin, options)
+
+
+class Runner(object):
+    '''Execute a set of plugin jobs concurrently on a thread or process pool.
+
+    Jobs start as soon as every job named in their ``after`` list has
+    succeeded; dependents of a failed job are skipped. Each returned value is
+    interpreted through :meth:`CLI.post_execute` and the run reports the
+    highest exit code seen.
+
+    The ``prefork`` pool runs jobs on :class:`pool.PluginPool` workers, forked
+    once with every plugin loaded, and returns large results through shared
+    memory.
+
+    A job that exceeds its timeout is reported with status 124. On the
+    process and prefork pools its worker is stopped by terminating the
+    pool's workers and starting a new pool; other jobs running at that
+    moment are restarted on it. Threads can't be preempted, so on the
+    thread pool a timed out job keeps running and the process still waits
+    for it before exiting. Plugin instances are shared between threads when
+    the same plugin is invoked more than once.
+    '''
+
+    def __init__(self, cli, workers=4, pool='thread', timeout=None):
+        self.cli = cli
+        self.workers = workers
+        self.pool = pool
+        self.timeout = timeout
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def executor(self):
+        if self.pool == 'prefork':
+            return PluginPool(self.cli.plugin_manager, workers=self.workers)
+        if self.pool == 'process':
+            return futures.ProcessPoolExecutor(max_workers=self.workers)
+        return futures.ThreadPoolExecutor(max_workers=self.workers)
+
+    def recycle(self, executor, running):
+        '''Terminate a process pool's workers and resubmit the *running* jobs to a new pool.
+
+        Returns the new executor and running futures.
+        '''
+        terminate_workers(executor)
+        executor = self.executor()
+        restarted = {}
+        for job in running.values():
+            self.log.warn('Job {0} restarted on a new worker pool'.format(job.name))
+            restarted[self.submit(executor, job)] = job
+        return executor, restarted
+
+    def submit(self, executor, job):
+        job.options = self.cli.parse_invocation(job.argv)
+        plug_class = job.options.plugin_class
+
+        if self.pool != 'thread':
+            # create (and truncate) the output once; workers append to it
+            self.cli.sinks.open(job.options.output)
+
+        if self.pool == 'prefork':
+            future = executor.submit(plug_class, job.options)
+        elif self.pool == 'process':
+            plugin_manager = self.cli.plugin_manager
+            entry = plugin_manager.get_plugin_entries()[plug_class]
+            future = executor.submit(execute_plugin, str(plugin_manager.plugin_path),
+                                     entry['module'], plug_class, job.options)
+        else:
+            plugin = self.cli.plugin_manager.prepare_plugin(plug_class)
+            future = executor.submit(self.cli.call_plugin, plugin, job.options)
+
+        job.state = 'running'
+        job.started = time.time()
+        if job.timeout is None:
+            job.timeout = self.timeout
+        return future
+
+    def finish(self, job, returned, state):
+        job.state = state
+        job.elapsed = time.time() - job.started if job.started else 0.0
+        if state == 'timeout':
+            job.status = TIMEOUT_STATUS
+        elif state == 'skipped':
+            job.status = SKIPPED_STATUS
+        else:
+            job.status = self.cli.post_execute(returned)
+
+        log = self.log.info if job.status == 0 else self.log.warn
+        log('Job {0} {1} with status {2} in {3:.3f}s'.format(job.name, job.state, job.status, job.elapsed))
+
+    def ready(self, job, jobs):
+        '''Return True, False (a dependency failed) or None (still waiting).'''
+        for dep in job.after:
+            status = jobs[dep].status
+            if status is None:
+                return None
+            if status != 0:
+                return False
+        return True
+
+    def run(self, jobs):
+        jobs_by_name = dict((job.name, job) for job in jobs)
+        pending = list(jobs)
+        running = {}
+
+        executor = self.executor()
+        try:
+            while pending or running:
+                for job in list(pending):
+                    ready = self.ready(job, jobs_by_name)
+                    if ready is None:
+                        continue
+
+                    pending.remove(job)
+                    if not ready:
+                        self.finish(job, None, 'skipped')
+                        continue
+
+                    try:
+                        running[self.submit(executor, job)] = job
+                    except (Exception, SystemExit) as err:
+                        self.log.error('Job {0} failed to start: {1!r}'.format(job.name, err))
+                        self.finish(job, err, 'failed')
+
+                if not running:
+                    continue
+
+                now = time.time()
+                deadlines = [job.started + job.timeout for job in running.values() if job.timeout]
+                wait_for = max(min(deadlines) - now, 0) if deadlines else None
+
+                done, _ = futures.wait(list(running), timeout=wait_for,
+                                       return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    try:
+                        self.finish(job, future.result(), 'done')
+                    except Exception as err:
+                        self.log.exception('Job {0} execution failure: {1}'.format(job.name, err))
+                        self.finish(job, err, 'failed')
+
+                now = time.time()
+                timed_out = False
+                for future, job in list(running.items()):
+                    if job.timeout and now - job.started >= job.timeout:
+                        future.cancel()
+                        running.pop(future)
+                        self.finish(job, None, 'timeout')
+                        timed_out = True
+
+                if timed_out and self.pool != 'thread':
+                    executor, running = self.recycle(executor, running)
+
+        finally:
+            if running and self.pool != 'thread':
+                terminate_workers(executor)
+            else:
+                executor.shutdown(wait=False)
+
+        return max([job.status for job in jobs] or [0])
+
+
+# lines without these split on whitespace exactly as shlex would split them
+SHELL_QUOTING = re.compile(r'[\'"\\#]')
+
+
+def read_batch(fp):
+    '''Yield (line number, argv) for each non-blank, non-comment line of *fp*.'''
+    for lineno, line in enumerate(fp, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        yield lineno, line
+
+
+class BatchRunner(object):
+    '''Execute one plugin invocation per input line against an already set up CLI.
+
+    Every line is parsed with :meth:`CLI.parse_invocation` and executed on a
+    plugin instance loaded once, so a batch pays for CLI initialization
+    only once. One JSON object per line is written to *output* with the
+    line number, argv, exit status and elapsed time, plus ``error`` for
+    lines that failed to parse or raised and ``result`` for returned values
+    that aren't exit codes. With more than one worker lines run on a thread
+    pool, at most ``2 * workers`` at a time, and results are written as
+    they complete. Given a :class:`pool.PluginPool`, those threads hand the
+    plugin executions to its worker processes. Records streamed by the
+    plugins share one --output per run, which can't be stdout while the
+    results are written there.
+    '''
+
+    def __init__(self, cli, workers=1, output=None, plugin_pool=None):
+        self.cli = cli
+        self.workers = workers
+        self.output = output or sys.stdout
+        self.plugin_pool = plugin_pool
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def invoke(self, lineno, line):
+        result = {'line': lineno, 'argv': line}
+        started = time.time()
+        returned = None
+        try:
+            argv = shlex.split(line) if SHELL_QUOTING.search(line) else line.split()
+            result['argv'] = argv
+            options = self.cli.parse_invocation(argv)
+            if options.output == '-' and self.output is sys.stdout:
+                # stdout carries the batch results
+                options.output = None
+            if self.plugin_pool is not None:
+                if options.output is not None:
+                    # create (and truncate) the output once; workers append to it
+                    self.cli.sinks.open(options.output)
+                returned = self.plugin_pool.execute(options.plugin_class, options)
+            else:
+                plugin = self.cli.plugin_manager.prepare_plugin(options.plugin_class)
+                returned = self.cli.call_plugin(plugin, options)
+        except SystemExit as err:
+            # argparse has already written the usage error to stderr
+            returned = err.code if isinstance(err.code, int) else 2
+            result['error'] = 'Invalid arguments'
+        except Exception as err:
+            returned = err
+            result['error'] = repr(err)
+
+        if returned is not None and not isinstance(returned, (int, Exception)):
+            result['result'] = returned
+        result['status'] = self.cli.post_execute(returned)
+        result['elapsed'] = time.time() - started
+        return result
+
+    def write(self, result):
+        self.output.write(json.dumps(result, default=repr) + '\n')
+        return result['status']
+
+    def run(self, lines):
+        '''Execute (line number, line) pairs, returning the highest exit status.'''
+        status = 0
+        if self.workers <= 1:
+            for lineno, line in lines:
+                status = max(status, self.write(self.invoke(lineno, line)))
+            self.output.flush()
+            return status
+
+        running = set()
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for lineno, line in lines:
+                if len(running) >= 2 * self.workers:
+                    done, running = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                    for future in done:
+                        status = max(status, self.write(future.result()))
+                running.add(executor.submit(self.invoke, lineno, line))
+
+            for future in futures.as_completed(running):
+                status = max(status, self.write(future.result()))
+
+        self.output.flush()
+        return status
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*
+import os
+import sys
+import copy
+import json
+import array
+import signal
+import socket
+import logging
+import threading
+import socketserver
+
+from client import HEADER, STATUS, INTERRUPT, recv_exactly
+
+logger = logging.getLogger(__name__)
+
+STDIO_FDS = 3
+
+INTERRUPTED_STATUS = 130
+
+
+def recv_request(sock):
+    '''Return (request dict, [stdin, stdout, stderr] descriptors).'''
+    fds = array.array('i')
+    msg, ancdata, _, _ = sock.recvmsg(HEADER.size, socket.CMSG_LEN(STDIO_FDS * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+
+    if len(msg) < HEADER.size:
+        msg += recv_exactly(sock, HEADER.size - len(msg))
+    size, = HEADER.unpack(msg)
+    request = json.loads(recv_exactly(sock, size).decode('utf-8'))
+    return request, list(fds)
+
+
+class InvocationHandler(socketserver.BaseRequestHandler):
+    '''Runs one client invocation in a process forked from the warm daemon.
+
+    The client's stdio descriptors replace the child's own, so plugin
+    output and logging go straight to the client's terminal or pipes.
+    '''
+
+    def handle(self):
+        cli = self.server.cli
+        try:
+            request, fds = recv_request(self.request)
+        except EOFError as err:
+            # e.g. another daemon probing whether this one is alive
+            logger.debug('Connection closed without a request: {0!r}'.format(err))
+            return
+        except (OSError, ValueError) as err:
+            logger.error('Bad request: {0!r}'.format(err))
+            return
+
+        for target, fd in enumerate(fds[:STDIO_FDS]):
+            os.dup2(fd, target)
+        for fd in fds:
+            os.close(fd)
+
+        os.environ.clear()
+        os.environ.update(request['env'])
+        os.chdir(request['cwd'])
+
+        # a daemon started in the background may have SIGINT ignored
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.done = False
+        watcher = threading.Thread(target=self.watch, name='InvocationWatcher')
+        watcher.daemon = True
+        watcher.start()
+
+        status = self.invoke(cli, request['argv'])
+
+        self.done = True
+        try:
+            self.request.sendall(STATUS.pack(status))
+        except OSError:
+            pass
+
+    def invoke(self, cli, argv):
+        if argv and argv[0] == 'serve':
+            sys.stderr.write('serve can not be run through the daemon\n')
+            return 1
+
+        # pre_execute parses sys.argv into a copy of the options as set up at startup
+        sys.argv = [sys.argv[0]] + list(argv)
+        cli.options = copy.copy(cli.defaults)
+        try:
+            status = cli.execute()
+        except SystemExit as exit:
+            status = exit.code
+        except KeyboardInterrupt:
+            status = INTERRUPTED_STATUS
+        finally:
+            cli.log_queue.stop()
+            for stream in (sys.stdout, sys.stderr):
+                try:
+                    stream.flush()
+                except (OSError, ValueError):
+                    pass
+
+        if status is None:
+            return 0
+        if not isinstance(status, int):
+            sys.stderr.write('{0}\n'.format(status))
+            return 1
+        return status
+
+    def watch(self):
+        '''Turn a client interrupt or hang-up into a KeyboardInterrupt.'''
+        try:
+            data = self.request.recv(1)
+        except OSError:
+            data = b''
+        if not self.done and (data == INTERRUPT or not data):
+            os.kill(os.getpid(), signal.SIGINT)
+
+
+class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    '''Unix socket daemon keeping a set up CLI resident.
+
+    Each connection is served by a forked child, which starts with the
+    daemon's imports, parsers, config and loaded plugins, so an invocation
+    skips interpreter start up and CLI initialization. Plugins and configs
+    are those of the directory the daemon was started in; invocations run
+    in the client's working directory with its environment.
+    '''
+
+    def __init__(self, cli, socket_path, max_children=40):
+        self.cli = cli
+        self.socket_path = socket_path
+        self.max_children = max_children
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                os.unlink(socket_path)
+            else:
+                raise OSError('A daemon is already listening on {0}'.format(socket_path))
+            finally:
+                probe.close()
+        socketserver.UnixStreamServer.__init__(self, socket_path, InvocationHandler)
+
+    def process_request(self, request, client_address):
+        # don't let the child inherit and later write out buffered daemon output
+        sys.stdout.flush()
+        sys.stderr.flush()
+        socketserver.ForkingMixIn.process_request(self, request, client_address)
+
+    def preload(self):
+        '''Import and set up every plugin so forked children start with them loaded.'''
+        self.cli.plugin_manager.preload()
+
+    def server_close(self):
+        super(Server, self).server_close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def serve(cli, socket_path, max_children=40):
+    '''Serve *cli* on *socket_path* until interrupted or terminated.'''
+    signal.signal(signal.SIGTERM, _terminate)
+    server = Server(cli, socket_path, max_children)
+    server.preload()
+    logger.warning('Serving {0} on {1}'.format(cli.name, socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
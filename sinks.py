@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*
+import os
+import sys
+import json
+import time
+import types
+import queue
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+# records held between a plugin and its sink before the plugin is made to wait
+BUFFER_SIZE = 10000
+BATCH_SIZE = 1000
+
+
+class SinkClosed(Exception):
+    '''Raised by a sink, or a :class:`SinkCache`, closed while a plugin still writes to it.'''
+
+
+def as_row(record):
+    return record if isinstance(record, dict) else {'value': record}
+
+
+class Sink(object):
+    '''Destination for streamed plugin records.
+
+    One sink is shared by every invocation writing to the same --output in
+    a process (see :class:`SinkCache`), so :meth:`write` takes a whole
+    batch, writes it as a unit and returns the number written.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, records, name):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FileSink(Sink):
+    '''A file, or stdout for ``-``.
+
+    With *append* the file is added to instead of truncated, as by worker
+    processes writing to an output their parent created. Each batch is
+    written under an exclusive ``flock`` so writers in other processes
+    don't interleave with it.
+    '''
+
+    def __init__(self, path, append=False):
+        super(FileSink, self).__init__()
+        self.path = path
+        if path == '-':
+            self.fp = sys.stdout
+        else:
+            self.fp = open(path, 'a' if append else 'w', newline='')
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.lock:
+            if self.closed:
+                raise SinkClosed(self.path)
+            try:
+                import fcntl
+                fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
+            except (ImportError, OSError, ValueError):
+                fcntl = None
+            try:
+                yield self.fp
+                self.fp.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+
+    def close(self):
+        if self.fp is sys.stdout:
+            self.fp.flush()
+        else:
+            self.fp.close()
+
+
+class JsonLinesSink(FileSink):
+    '''One JSON document per record; values JSON can't encode are written as their repr.'''
+
+    def write(self, records, name):
+        lines = ''.join(json.dumps(record, default=repr) + '\n' for record in records)
+        with self.locked() as fp:
+            fp.write(lines)
+        return len(records)
+
+
+class CsvSink(FileSink):
+    '''CSV with a header taken from the first record; later keys not in it are dropped.
+
+    The header is written by whichever writer finds the file empty; the
+    others read it back and use its columns, so every process writes rows
+    in the same order.
+    '''
+
+    def __init__(self, path, append=False):
+        super(CsvSink, self).__init__(path, append)
+        self.writer = None
+        self.header_written = False
+
+    def empty(self):
+        if self.fp is sys.stdout:
+            return not self.header_written
+        return os.fstat(self.fp.fileno()).st_size == 0
+
+    def header(self):
+        '''Return the columns of the header already in the file.'''
+        import csv
+
+        with open(self.path, newline='') as fp:
+            return next(csv.reader(fp), [])
+
+    def write(self, records, name):
+        import csv
+
+        rows = [as_row(record) for record in records]
+        with self.locked() as fp:
+            if self.writer is None:
+                empty = self.empty()
+                fieldnames = list(rows[0]) if empty else self.header()
+                self.writer = csv.DictWriter(fp, fieldnames=fieldnames, extrasaction='ignore')
+            if self.empty():
+                self.writer.writeheader()
+                self.header_written = True
+            self.writer.writerows(rows)
+        return len(rows)
+
+
+# unlike sqla.DEFAULT_INGEST_PRAGMAS, leave journal_mode alone (other writers may
+# have the file open) and keep the default page cache so memory stays flat
+INGEST_PRAGMAS = (
+    ('synchronous', 'OFF'),
+)
+
+
+class SqliteSink(Sink):
+    '''Rows in SQLite tables through :meth:`sqla.SAContext.bulk_insert`.
+
+    Records go to *table*, or to a table named after each plugin. A
+    missing table is created from the first record's keys, with column
+    types guessed from its values; rows are then fitted to the table's
+    columns, missing keys becoming NULL and extra keys being dropped.
+    Values SQLite can't store are written as JSON. The sink keeps one
+    connection, with :data:`INGEST_PRAGMAS` applied, and commits once per
+    batch.
+    '''
+
+    def __init__(self, path, table=None):
+        super(SqliteSink, self).__init__()
+        from sqlalchemy.pool import StaticPool
+        from sqla import SAContext
+
+        self.table_name = table
+        self.tables = {}
+        self.sa = SAContext()
+        self.sa.create_engine('sqlite:///{0}'.format(path), poolclass=StaticPool,
+                              connect_args={'check_same_thread': False})
+        self.conn = self.sa.engine.connect()
+        self.pragmas = self.sa.sqlite_pragmas(self.conn, INGEST_PRAGMAS)
+        self.pragmas.__enter__()
+
+    @staticmethod
+    def row(record):
+        row = dict(as_row(record))
+        for key, value in row.items():
+            if value is not None and not isinstance(value, (str, int, float, bytes)):
+                # lists, tuples, dicts and the like go in as JSON text
+                row[key] = json.dumps(value, default=repr)
+        return row
+
+    def table(self, name, row):
+        from sqlalchemy import Table, Column, Integer, Float, Boolean, LargeBinary, Text, exc
+
+        table = self.tables.get(name)
+        if table is not None:
+            return table
+
+        if not self.sa.engine.has_table(name):
+            column_types = {bool: Boolean, int: Integer, float: Float, bytes: LargeBinary}
+            columns = [Column(key, column_types.get(type(value), Text)) for key, value in row.items()]
+            try:
+                self.sa.create_tables([Table(name, self.sa.metadata, *columns)])
+            except exc.OperationalError as err:
+                # another writer created it first
+                logger.debug('Table {0} not created: {1!r}'.format(name, err))
+
+        table = self.tables[name] = Table(name, self.sa.metadata, autoload=True,
+                                          autoload_with=self.sa.engine, extend_existing=True)
+        return table
+
+    def write(self, records, name):
+        rows = [self.row(record) for record in records]
+        with self.lock:
+            if self.closed:
+                raise SinkClosed(self.table_name or name)
+            table = self.table(self.table_name or name, rows[0])
+            columns = [column.key for column in table.columns]
+            rows = [dict((key, row.get(key)) for key in columns) for row in rows]
+            report = self.sa.bulk_insert(table, rows, columns=columns, batch_size=len(rows),
+                                         commit_every=len(rows), pragmas=())
+        return report['rows']
+
+    def close(self):
+        try:
+            self.pragmas.__exit__(None, None, None)
+        finally:
+            self.conn.close()
+            self.sa.engine.dispose()
+
+
+def make_sink(spec='-', append=False):
+    '''Return the sink for an --output spec.
+
+    ``-`` or ``jsonl:-`` is JSON Lines on stdout, ``jsonl:PATH`` or
+    ``*.jsonl`` a JSON Lines file, ``csv:PATH`` or ``*.csv`` a CSV file and
+    ``sqlite:PATH[:TABLE]`` or ``*.sqlite3``/``*.db`` a SQLite database
+    (by default with a table per plugin). Files are truncated unless
+    *append* is set.
+    '''
+    kind, _, target = spec.partition(':')
+    if not target:
+        kind, target = None, spec
+    if kind is None:
+        if target.endswith('.csv'):
+            kind = 'csv'
+        elif target.endswith(('.sqlite3', '.sqlite', '.db')):
+            kind = 'sqlite'
+        else:
+            kind = 'jsonl'
+
+    if kind == 'jsonl':
+        return JsonLinesSink(target, append)
+    if kind == 'csv':
+        return CsvSink(target, append)
+    if kind == 'sqlite':
+        path, _, table = target.partition(':')
+        return SqliteSink(path, table or None)
+    raise ValueError('Unknown output kind {0!r} in {1!r}'.format(kind, spec))
+
+
+class SinkCache(object):
+    '''Sinks by --output spec, each opened once and shared by every invocation in a process.
+
+    The CLI opens (and so truncates) its outputs once per run; worker
+    processes use :data:`worker_sinks`, which appends to them. Once the
+    cache is closed, opening or writing to its sinks raises
+    :class:`SinkClosed`, so a job abandoned by a timeout stops instead of
+    writing to (or truncating) an output its run has finished with.
+    '''
+
+    def __init__(self, append=False):
+        self.append = append
+        self.sinks = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def open(self, spec):
+        with self.lock:
+            if self.closed:
+                raise SinkClosed(spec)
+            sink = self.sinks.get(spec)
+            if sink is None:
+                sink = self.sinks[spec] = make_sink(spec, self.append)
+            return sink
+
+    def close(self):
+        with self.lock:
+            sinks, self.sinks = self.sinks, {}
+            self.closed = True
+        for spec, sink in sinks.items():
+            try:
+                # under the sink's lock, so a batch being written finishes first
+                with sink.lock:
+                    sink.closed = True
+                    sink.close()
+            except Exception as err:
+                logger.error('Output {0} not closed: {1!r}'.format(spec, err))
+
+
+# outputs of plugins executed in pool worker processes
+worker_sinks = SinkCache(append=True)
+
+
+class ResultStream(object):
+    '''Moves records from a plugin's generator to a sink on a writer thread.
+
+    Records are passed on in batches of *batch_size* through a queue
+    holding at most *buffer_size* records; when the sink falls behind the
+    plugin blocks (or, for an async generator, awaits) until there is
+    room, so memory stays flat however many records are produced. A sink
+    error stops the generator and is raised from :meth:`run`.
+    '''
+
+    def __init__(self, sink, name='results', buffer_size=BUFFER_SIZE, batch_size=BATCH_SIZE):
+        self.sink = sink
+        self.name = name
+        self.batch_size = min(batch_size, buffer_size)
+        self.queue = queue.Queue(max(1, buffer_size // self.batch_size))
+        self.error = None
+        self.count = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.writer, name='ResultStream')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def writer(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            # after an error keep draining, so a producer blocked on the queue can see it
+            if self.error is not None:
+                continue
+            try:
+                self.count += self.sink.write(batch, self.name)
+            except BaseException as err:
+                self.error = err
+
+    def put(self, batch):
+        if self.error is not None:
+            raise self.error
+        if batch:
+            self.queue.put(batch)
+
+    def finish(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.count
+
+    def run(self, records):
+        '''Stream a generator of records, returning the number written.'''
+        self.start()
+        batch = []
+        try:
+            for record in records:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    self.put(batch)
+                    batch = []
+            self.put(batch)
+        except BaseException:
+            records.close()
+            self.finish()
+            raise
+        return self.finish()
+
+    async def run_async(self, records):
+        '''Stream an async generator of records, returning the number written.'''
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        self.start()
+        batch = []
+        try:
+            async for record in records:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    await loop.run_in_executor(None, self.put, batch)
+                    batch = []
+            await loop.run_in_executor(None, self.put, batch)
+        except BaseException:
+            await records.aclose()
+            await loop.run_in_executor(None, self.finish)
+            raise
+        return await loop.run_in_executor(None, self.finish)
+
+
+def stream_results(returned, sink, name='results', buffer_size=BUFFER_SIZE):
+    '''Write the records of a plugin's generator or async generator to *sink*.
+
+    Returns the number of records written.
+    '''
+    from plugin import run_coroutine
+
+    started = time.time()
+    stream = ResultStream(sink, name, buffer_size)
+    try:
+        if isinstance(returned, types.AsyncGeneratorType):
+            count = run_coroutine(stream.run_async(returned))
+        else:
+            count = stream.run(returned)
+    except SinkClosed:
+        logger.info('Output closed, {0} stopped after {1} records'.format(name, stream.count))
+        return stream.count
+    logger.info('Streamed {0} records from {1} in {2:.3f}s'.format(count, name, time.time() - started))
+    return count
@@ -4,25 +4,42 @@ import logging
 logger = logging.getLogger(__file__)
 try:
     import sqlalchemy
-except ImportError, err:
+except ImportError as err:
     #logger.error('SqlAlchemy import not available')
-    raise LibraryImportError('SqlAlchemy import not available ({0})'.format(err))
+    raise ImportError('SqlAlchemy import not available ({0})'.format(err))
 
 from sqlalchemy.orm import RelationshipProperty, ColumnProperty, SynonymProperty
 import sqlalchemy.orm.collections
+from sqlalchemy.orm.collections import InstrumentedList
+from sqlalchemy.orm.query import Query
 
 from sqlalchemy import (Table, Column, ForeignKey, Sequence, desc,
                         UniqueConstraint, and_, or_, MetaData, create_engine,
                         __version__ as sa_version)
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import mapper, sessionmaker, scoped_session, validates
 from sqlalchemy.orm import relation, backref, deferred, eagerload
 import sqlite3
+import time
+import itertools
+import heapq
+import queue
+import threading
+from operator import itemgetter
 
 from contextlib import contextmanager
 
+# SQLite settings applied for the duration of SAContext.bulk_insert
+DEFAULT_INGEST_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'OFF'),
+    ('cache_size', -262144),
+)
+
 @contextmanager
 def managed(sessionClass, auto_flush=False, auto_commit=False, callback=None):
     session = sessionClass()
@@ -75,13 +92,50 @@ default_fromdict_allow_pk = False
 
 
 
+class ModelKeys(object):
+    """Property keys of a mapped class, computed once per class"""
+    __slots__ = ('columns', 'synonyms', 'relations', 'primary_keys', 'underscore', 'attributes')
+
+    def __init__(self, cls):
+        properties = list(cls.__mapper__.iterate_properties)
+        self.columns = tuple(k.key for k in properties if isinstance(k, ColumnProperty))
+        self.synonyms = tuple(k.key for k in properties if isinstance(k, SynonymProperty))
+        self.relations = frozenset(k.key for k in properties if isinstance(k, RelationshipProperty))
+        self.underscore = frozenset(k.key for k in properties if k.key[0] == '_')
+        self.attributes = frozenset(self.columns + self.synonyms)
+
+        # Find primary keys
+        primary_keys = set()
+        for k in properties:
+            if hasattr(k, 'columns'):
+                for c in k.columns:
+                    if c.primary_key:
+                        primary_keys.add(k.key)
+        self.primary_keys = frozenset(primary_keys)
+
+
+_model_keys = {}
+
+# (class, exclude, exclude_underscore, exclude_pk) -> keys read by asdict
+_asdict_keys = {}
+
+
+def get_model_keys(model):
+    """Get the cached :class:`ModelKeys` for a model class or instance"""
+    cls = model if isinstance(model, type) else type(model)
+    try:
+        return _model_keys[cls]
+    except KeyError:
+        keys = _model_keys[cls] = ModelKeys(cls)
+        return keys
+
+
 def get_relation_keys(model):
     """Get relation keys for a model
 
     :returns: List of RelationProperties
     """
-    return [k.key for k in model.__mapper__.iterate_properties if
-            isinstance(k, RelationshipProperty)]
+    return list(get_model_keys(model).relations)
 
 
 def get_column_keys(model):
@@ -89,8 +143,7 @@ def get_column_keys(model):
 
     :returns: List of column keys
     """
-    return [k.key for k in model.__mapper__.iterate_properties if
-            isinstance(k, ColumnProperty)]
+    return list(get_model_keys(model).columns)
 
 
 def get_synonym_keys(model):
@@ -98,8 +151,7 @@ def get_synonym_keys(model):
 
     :returns: List of keys for synonyms
     """
-    return [k.key for k in model.__mapper__.iterate_properties if
-            isinstance(k, SynonymProperty)]
+    return list(get_model_keys(model).synonyms)
 
 
 def get_primary_key_properties(model):
@@ -107,14 +159,48 @@ def get_primary_key_properties(model):
 
     :returns: Set of column keys
     """
-    # Find primary keys
-    primary_keys = set()
-    for k in model.__mapper__.iterate_properties:
-        if hasattr(k, 'columns'):
-            for c in k.columns:
-                if c.primary_key:
-                    primary_keys.add(k.key)
-    return primary_keys
+    return set(get_model_keys(model).primary_keys)
+
+
+def _follow_dict(follow):
+    if follow == None:
+        follow = []
+    try:
+        return dict(follow)
+    except ValueError:
+        return dict.fromkeys(list(follow), {})
+
+
+def get_asdict_keys(model, exclude=None, exclude_underscore=None, exclude_pk=None):
+    """Get the keys :func:`asdict` reads for a model with these options
+
+    The result is cached per class and set of options.
+
+    :returns: Tuple of keys
+    """
+    cls = model if isinstance(model, type) else type(model)
+    exclude = frozenset(exclude or ())
+    if exclude_underscore is None:
+        exclude_underscore = getattr(cls, 'dictalchemy_exclude_underscore', default_exclude_underscore)
+
+    cache_key = (cls, exclude, bool(exclude_underscore), exclude_pk is True)
+    try:
+        return _asdict_keys[cache_key]
+    except KeyError:
+        pass
+
+    model_keys = get_model_keys(cls)
+    excluded = set(exclude)
+    excluded.update(getattr(cls, 'dictalchemy_exclude', default_exclude) or [])
+    if exclude_underscore:
+        # Exclude all properties starting with underscore
+        excluded.update(model_keys.underscore)
+    if exclude_pk is True:
+        excluded.update(model_keys.primary_keys)
+
+    keys = _asdict_keys[cache_key] = tuple(k for k in model_keys.columns + model_keys.synonyms
+                                           if k not in excluded)
+    return keys
 
 
 def asdict(self, exclude=None, exclude_underscore=None, exclude_pk=None, follow=None):
@@ -135,33 +221,16 @@ def asdict(self, exclude=None, exclude_underscore=None, exclude_pk=None, follow=
     :returns: dict
 
     """
-    if follow == None:
-        follow = []
-    try:
-        follow = dict(follow)
-    except ValueError:
-        follow = dict.fromkeys(list(follow), {})
+    follow = _follow_dict(follow)
+    keys = get_asdict_keys(self, exclude, exclude_underscore, exclude_pk)
 
-    exclude = exclude or []
-    exclude += getattr(self, 'dictalchemy_exclude', default_exclude) \
-        or []
-    if exclude_underscore is None:
-        exclude_underscore = getattr(self, 'dictalchemy_exclude_underscore', default_exclude_underscore)
-    if exclude_underscore:
-        # Exclude all properties starting with underscore
-        exclude += [k.key for k in self.__mapper__.iterate_properties \
-                    if k.key[0] == '_']
-    if exclude_pk is True:self.Session = sessionmaker(bind=self.engine)
-    exclude += get_primary_key_properties(self)
-
-    columns = get_column_keys(self)
-    synonyms = get_synonym_keys(self)
-    relations = get_relation_keys(self)
+    data = dict([(k, getattr(self, k)) for k in keys])
 
-    data = dict([(k, getattr(self, k)) for k in columns + synonyms \
-                 if k not in exclude])
+    if not follow:
+        return data
 
-    for (k, args) in follow.iteritems():
+    relations = get_model_keys(self).relations
+    for (k, args) in follow.items():
         if k not in relations:
             raise ValueError( \
                 "Key '%r' in parameter 'follow' is not a relations" % \
@@ -181,6 +250,49 @@ def asdict(self, exclude=None, exclude_underscore=None, exclude_pk=None, follow=
     return data
 
 
+def _query_entity(query):
+    """Return the mapped class a single-entity Query selects, else None"""
+    if not isinstance(query, Query):
+        return None
+
+    descriptions = query.column_descriptions
+    if len(descriptions) != 1:
+        return None
+
+    entity = descriptions[0]['expr']
+    if isinstance(entity, type) and hasattr(entity, '__mapper__'):
+        return entity
+    return None
+
+
+def asdicts(rows, exclude=None, exclude_underscore=None, exclude_pk=None, follow=None, yield_per=1000):
+    """Yield a dict per model in *rows*, an iterable of models or a Query
+
+    When *rows* is a Query for a single mapped class and no relationships
+    are followed, only the needed columns are selected and dicts are built
+    from the returned tuples, so no ORM instances are created. Other
+    iterables are serialized with :func:`asdict`, reusing the cached keys.
+
+    :returns: generator of dicts
+    """
+    cls = _query_entity(rows)
+    if cls is not None and not follow:
+        keys = get_asdict_keys(cls, exclude, exclude_underscore, exclude_pk)
+        query = rows.with_entities(*[getattr(cls, k) for k in keys])
+        if yield_per:
+            query = query.yield_per(yield_per)
+        for row in query:
+            yield dict(zip(keys, row))
+        return
+
+    for row in rows:
+        if follow:
+            yield asdict(row, exclude, exclude_underscore, exclude_pk, follow)
+        else:
+            keys = get_asdict_keys(row, exclude, exclude_underscore, exclude_pk)
+            yield dict([(k, getattr(row, k)) for k in keys])
+
+
 def fromdict(self, data, exclude=None, exclude_underscore=None, allow_pk=None, follow=None):
     """Update a model from a dict
 
@@ -207,46 +319,35 @@ def fromdict(self, data, exclude=None, exclude_underscore=None, allow_pk=None, f
     :returns nothing:
 
     """
+    follow = _follow_dict(follow)
+    model_keys = get_model_keys(self)
 
-    if follow == None:
-        follow = []
-    try:
-        follow = dict(follow)
-    except ValueError:
-        follow = dict.fromkeys(list(follow), {})
-
-    exclude = exclude or []
-    exclude += getattr(self, 'dictalchemy_exclude', default_exclude) or []
+    excluded = set(exclude or [])
+    excluded.update(getattr(self, 'dictalchemy_exclude', default_exclude) or [])
     if exclude_underscore is None:
         exclude_underscore = getattr(self, 'dictalchemy_exclude_underscore', default_exclude_underscore)
 
     if exclude_underscore:
         # Exclude all properties starting with underscore
-        exclude += [k.key for k in self.__mapper__.iterate_properties \
-                    if k.key[0] == '_']
+        excluded.update(model_keys.underscore)
 
     if allow_pk is None:
         allow_pk = getattr(self, 'dictalchemy_fromdict_allow_pk', default_fromdict_allow_pk)
 
-    columns = get_column_keys(self)
-    synonyms = get_synonym_keys(self)
-    relations = get_relation_keys(self)
-    primary_keys = get_primary_key_properties(self)
-
     # Update simple data
-    for k, v in data.iteritems():
-        if not allow_pk and k in primary_keys:
+    for k, v in data.items():
+        if not allow_pk and k in model_keys.primary_keys:
             raise Exception("Primary key(%r) cannot be updated by fromdict."
                             "Set 'dictalchemy_fromdict_allow_pk' to True in your Model"
                             " or pass 'allow_pk=True'." % k)
-        if k in columns + synonyms:
+        if k in model_keys.attributes and k not in excluded:
             setattr(self, k, v)
 
     # Update simple relations
-    for (k, args) in follow.iteritems():
+    for (k, args) in follow.items():
         if k not in data:
             continue
-        if k not in relations:
+        if k not in model_keys.relations:
             raise ValueError( \
                 "Key '%r' in parameter 'follow' is not a relations" % \
                 k)
@@ -257,7 +358,7 @@ def fromdict(self, data, exclude=None, exclude_underscore=None, allow_pk=None, f
 
 def iter(model):
     """iter method for models"""
-    for i in model.asdict().iteritems():
+    for i in model.asdict().items():
         yield i
 
 
@@ -287,6 +388,206 @@ def make_class_dictable(cls, exclude=default_exclude,
     return cls
 
 
+def attach_databases(conn, dbList):
+    """ATTACH each path in *dbList* to a sqlite3 connection as db1..dbN
+
+    :returns: List of (alias, path)
+    """
+    aliases = []
+    for ndx, dbPath in enumerate(dbList, 1):
+        alias = 'db{0}'.format(ndx)
+        conn.execute('ATTACH DATABASE ? AS {0}'.format(alias), (str(dbPath),))
+        aliases.append((alias, dbPath))
+
+    logger.debug('Attached databases: {0!r}'.format(aliases))
+    return aliases
+
+
+def sqlite_sort_key(value):
+    """Key ordering values as SQLite does: NULL, then numbers, text and blobs"""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        # code point order, the same as SQLite's BINARY collation of UTF-8
+        return (2, value)
+    return (3, bytes(value))
+
+
+def sqlite_row_key(columns):
+    """Key ordering rows on result *columns* as an SQLite ORDER BY does"""
+    return lambda row: tuple(sqlite_sort_key(row[ndx]) for ndx in columns)
+
+
+# combine per-shard partial aggregates
+SHARD_AGGREGATES = {
+    'count': lambda a, b: a + b,
+    'sum': lambda a, b: b if a is None else a if b is None else a + b,
+    'min': lambda a, b: b if a is None else a if b is None else min(a, b, key=sqlite_sort_key),
+    'max': lambda a, b: b if a is None else a if b is None else max(a, b, key=sqlite_sort_key),
+}
+
+
+def _put(out, item, stop):
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def query_shard(dbPath, sql, params, batch_size, out, stop):
+    """Run *sql* against one shard, streaming batches of rows onto *out*
+
+    Puts lists of rows, then None when done, or the exception raised.
+    """
+    try:
+        conn = sqlite3.connect(str(dbPath))
+        try:
+            cursor = conn.execute(sql, params)
+            while not stop.is_set():
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                if not _put(out, rows, stop):
+                    return
+        finally:
+            conn.close()
+        _put(out, None, stop)
+    except Exception as err:
+        _put(out, err, stop)
+    finally:
+        if stop.is_set() and hasattr(out, 'cancel_join_thread'):
+            # the reader is gone; don't block process exit flushing the queue
+            out.cancel_join_thread()
+
+
+class ShardedQuery(object):
+    """Run the same select against every shard database concurrently.
+
+    Each shard is queried on its own connection in its own thread (or
+    process with *processes*), and rows are streamed back through bounded
+    queues so at most *queue_size* batches per shard are held in memory.
+    Usage::
+
+        shards = ShardedQuery(['2024-01-01.db', '2024-01-02.db'])
+        # rows from whichever shard answers first
+        for row in shards.execute('SELECT host, port FROM scan WHERE port = ?', (22,)):
+            ...
+        # k-way merge of the per-shard ORDER BY on result column 0
+        shards.execute('SELECT ts, host FROM scan ORDER BY ts', order_by=[0])
+        # partial aggregates combined across shards, grouped on column 0
+        shards.execute('SELECT host, COUNT(*), MAX(ts) FROM scan GROUP BY host',
+                       aggregate=[None, 'count', 'max'])
+    """
+
+    def __init__(self, dbList, processes=False, batch_size=1000, queue_size=8):
+        self.dbList = list(dbList)
+        self.processes = processes
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+
+    @contextmanager
+    def stream(self, sql, params=(), merged=False):
+        """Start a query on every shard and yield its row streams
+
+        Yields one row generator per shard, or with *merged* a single
+        generator returning rows from whichever shard has a batch ready.
+        """
+        if self.processes:
+            import multiprocessing
+            stop = multiprocessing.Event()
+            make_queue, make_worker = multiprocessing.Queue, multiprocessing.Process
+        else:
+            stop = threading.Event()
+            make_queue, make_worker = queue.Queue, threading.Thread
+
+        if merged:
+            queues = [make_queue(self.queue_size * len(self.dbList))] * len(self.dbList)
+        else:
+            queues = [make_queue(self.queue_size) for _ in self.dbList]
+
+        workers = [make_worker(target=query_shard, args=(path, sql, tuple(params), self.batch_size, out, stop))
+                   for path, out in zip(self.dbList, queues)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        def rows(out, pending):
+            while pending:
+                batch = out.get()
+                if batch is None:
+                    pending -= 1
+                    continue
+                if isinstance(batch, Exception):
+                    raise batch
+                for row in batch:
+                    yield row
+
+        try:
+            if merged:
+                yield rows(queues[0], len(self.dbList))
+            else:
+                yield [rows(out, 1) for out in queues]
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+
+    def execute(self, sql, params=(), order_by=None, reverse=False, aggregate=None):
+        """Yield the rows of *sql* across all shards
+
+        Without *order_by* or *aggregate*, rows come back in the order the
+        shards produce them.
+
+        :param order_by: Result column indexes the query orders by; the \
+                sorted shard streams are k-way merged on them, comparing \
+                values in SQLite's order (NULLs first, then numbers, text \
+                and blobs).
+        :param reverse: True if the query orders descending.
+        :param aggregate: One entry per result column: 'count', 'sum', \
+                'min', 'max', or None for GROUP BY key columns. Partial \
+                results from each shard are combined per group.
+        """
+        if aggregate is not None:
+            unknown = set(aggregate) - set(SHARD_AGGREGATES) - set([None])
+            if unknown:
+                raise ValueError('Unsupported shard aggregates {0!r}'.format(sorted(unknown)))
+
+        merged = not order_by or aggregate is not None
+        with self.stream(sql, params, merged=merged) as shards:
+            if aggregate is not None:
+                rows = self.combine(shards, aggregate)
+                if order_by:
+                    rows = sorted(rows, key=sqlite_row_key(order_by), reverse=reverse)
+            elif order_by:
+                rows = heapq.merge(*shards, key=sqlite_row_key(order_by), reverse=reverse)
+            else:
+                rows = shards
+
+            for row in rows:
+                yield row
+
+    def combine(self, rows, aggregate):
+        keys = [ndx for ndx, func in enumerate(aggregate) if func is None]
+        funcs = [(ndx, SHARD_AGGREGATES[func]) for ndx, func in enumerate(aggregate) if func is not None]
+
+        groups = {}
+        for row in rows:
+            group = tuple(row[ndx] for ndx in keys)
+            current = groups.get(group)
+            if current is None:
+                groups[group] = list(row)
+                continue
+            for ndx, func in funcs:
+                current[ndx] = func(current[ndx], row[ndx])
+
+        return [tuple(row) for row in groups.values()]
+
+
 class SAContext(object):
     '''Convenient SQLALchemy initialization.
 
@@ -313,17 +614,16 @@ class SAContext(object):
         # You can also create a copy of sa, bound to another engine:
         sa2 = sa.clone('sqlite://')
     '''
-    __slots__ = ('metadata', 'base', 'dbURI', 'engine', 'Session')
+    __slots__ = ('metadata', 'base', 'dbURI', 'engine', 'Session', 'attached')
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, metadata=None, base=None, debug=False):
 
-        #if self.debugFlag:
-        logging.getLogger('sqlalchemy.engine').setLevel(logging.DEBUG)
-        logging.getLogger('sqlalchemy.dialects').setLevel(logging.DEBUG)
-        logging.getLogger('sqlalchemy.pool').setLevel(logging.DEBUG)
-        logging.getLogger('sqlalchemy.orm').setLevel(logging.DEBUG)
-
-        self.echo=False
+        # debug logging makes SQLAlchemy format every statement and row
+        if debug:
+            logging.getLogger('sqlalchemy.engine').setLevel(logging.DEBUG)
+            logging.getLogger('sqlalchemy.dialects').setLevel(logging.DEBUG)
+            logging.getLogger('sqlalchemy.pool').setLevel(logging.DEBUG)
+            logging.getLogger('sqlalchemy.orm').setLevel(logging.DEBUG)
 
         #if self.verbose:
         #    logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
@@ -334,48 +634,54 @@ class SAContext(object):
 
         #if dbURI:
         #   self.create_engine(dbURI, echo=True, **kwargs)
-        self.base = model.Base
-        self.metadata = model.metadata
+        if base is not None:
+            metadata = base.metadata
+        self.metadata = metadata if metadata is not None else MetaData()
+        self.base = base if base is not None else declarative_base(metadata=self.metadata)
 
 
     def connect_databases(self, dbList):
-        conn = None
-        for ndx, dbPath in enumerate(dbList):
-            if ndx == 0:
-                conn = sqlite3.connect(dbPath)
-            else:
-                conn.execute("ATTACH DATABASE '{0}' AS 'db{1}'".format(dbPath, ndx))
-
-        print conn
-        cur = conn.cursor()
-        cur.execute('PRAGMA database_list;')
-        print cur.fetchall()
-
-
+        """Open the first database in *dbList* and attach the rest as db1..dbN"""
+        dbList = list(dbList)
+        conn = sqlite3.connect(dbList[0])
+        attach_databases(conn, dbList[1:])
         return conn
 
 
-    def setup_attached_engine(self, dbURI, dbList):
+    def setup_attached_engine(self, dbURI, dbList, pool_size=5, max_overflow=10, echo=False, **kwargs):
+        """Bind a pooled engine whose connections all see the attached databases.
 
-        def connect_databases(dbList):
+        The first database in *dbList* is the main one and the rest are
+        attached as db1..dbN. Every new pooled connection runs the ATTACH
+        set when it is opened, so connections can be checked out from any
+        thread; :attr:`Session` is a thread-local scoped_session.
+        """
+        dbList = list(dbList)
+        mainDB, attached = dbList[0], dbList[1:]
 
-            initDB = dbList.pop()
-            conn = sqlite3.connect(initDB)
-            for ndx, dbPath in enumerate(dbList):
-                conn.execute("ATTACH DATABASE '{0}' AS 'db{1}'".format(dbPath, ndx))
+        def connect():
+            # pooled connections are handed between threads
+            return sqlite3.connect(mainDB, check_same_thread=False)
 
-            cur = conn.cursor()
-            cur.execute('PRAGMA database_list;')
-            print cur.fetchall()
+        self.dbURI = dbURI
+        self.attached = dbList
+        self.engine = create_engine(dbURI, echo=echo, creator=connect, poolclass=QueuePool,
+                                    pool_size=pool_size, max_overflow=max_overflow, **kwargs)
 
-            return conn
+        @event.listens_for(self.engine, 'connect')
+        def on_connect(dbapi_conn, connection_record):
+            attach_databases(dbapi_conn, attached)
 
-        self.engine = create_engine(dbURI, echo=True, creator=connect_databases(dbList))
         self.metadata.bind = self.engine
-        self.Session = sessionmaker(bind=self.engine)
-        #self.Session = scoped_session(sessionmaker(bind=self.engine))
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
         return self
 
+    def fan_out(self, sql, params=(), processes=False, **kwargs):
+        '''Run *sql* against every database given to setup_attached_engine
+        concurrently, one connection each. See :meth:`ShardedQuery.execute`.
+        '''
+        return ShardedQuery(self.attached, processes=processes).execute(sql, params, **kwargs)
+
 
     # cur.execute('PRAGMA database_list') 3rd parameter is database
 
@@ -402,6 +708,122 @@ class SAContext(object):
         #self.metadata.create_all(tables=tables, bind=self.engine)
         return self
 
+    def resolve_table(self, table):
+        '''Returns the Table for a Table, mapped class or table name.'''
+        if isinstance(table, Table):
+            return table
+        if hasattr(table, '__table__'):
+            return table.__table__
+        return self.metadata.tables[table]
+
+    @contextmanager
+    def sqlite_pragmas(self, conn, pragmas):
+        '''Apply (name, value) PRAGMAs on *conn*, restoring the old values afterwards.'''
+        previous = []
+        try:
+            for name, value in pragmas:
+                previous.append((name, conn.execute('PRAGMA {0}'.format(name)).scalar()))
+                conn.execute('PRAGMA {0} = {1}'.format(name, value))
+            yield conn
+        finally:
+            for name, value in reversed(previous):
+                conn.execute('PRAGMA {0} = {1}'.format(name, value))
+
+    def bulk_insert(self, table, rows, columns=None, batch_size=10000, commit_every=100000, pragmas=None):
+        '''Insert an iterable of dicts or tuples into *table* in batches.
+
+        *table* is a Table, mapped class or table name. Tuples are in the
+        order of *columns* (default: the table's columns); dict rows take
+        their columns from the first row unless *columns* is given.
+
+        Rows are written with one executemany per *batch_size* rows and a
+        commit every *commit_every* rows. When no column type needs bind
+        processing and no column left out of the rows has a Python side
+        default, the statement is compiled once and the batches go straight
+        to the DBAPI cursor. On SQLite, *pragmas* (default
+        DEFAULT_INGEST_PRAGMAS, pass () to disable) are applied for the
+        duration of the load. Usage::
+
+            report = sa.bulk_insert('scan_result', iter_results(), batch_size=50000)
+            report['rows_per_sec']
+
+        :returns: dict with table, rows, seconds and rows_per_sec
+        '''
+        table = self.resolve_table(table)
+        # iter() is shadowed in this module by the model iter helper
+        rows = itertools.chain(rows)
+        first = next(rows, None)
+        report = {'table': table.name, 'rows': 0, 'seconds': 0.0, 'rows_per_sec': 0.0}
+        if first is None:
+            return report
+
+        as_dicts = isinstance(first, dict)
+        if columns is None:
+            columns = list(first.keys()) if as_dicts else [c.key for c in table.columns]
+        columns = list(columns)
+
+        dialect = self.engine.dialect
+        stmt = table.insert()
+        raw = dialect.positional and \
+            all(table.c[k].type.bind_processor(dialect) is None for k in columns)
+        if raw:
+            compiled = stmt.compile(dialect=dialect, column_keys=columns)
+            order = list(compiled.positiontup)
+            # columns with Python side defaults are added to the statement and
+            # need SQLAlchemy to fill them in, so only go raw on an exact match
+            raw = sorted(order) == sorted(columns)
+        if raw:
+            sql = str(compiled)
+            if as_dicts:
+                getter = itemgetter(*order)
+            elif order != columns:
+                getter = itemgetter(*[columns.index(k) for k in order])
+            else:
+                getter = None
+            if getter is not None and len(order) == 1:
+                getter = lambda row, get=getter: (get(row),)
+
+        if pragmas is None:
+            pragmas = DEFAULT_INGEST_PRAGMAS if dialect.name == 'sqlite' else ()
+
+        started = time.time()
+        count = 0
+        with self.engine.connect() as conn, self.sqlite_pragmas(conn, pragmas):
+            trans = conn.begin()
+            pending = 0
+            try:
+                source = itertools.chain([first], rows)
+                while True:
+                    batch = list(itertools.islice(source, batch_size))
+                    if not batch:
+                        break
+
+                    if raw:
+                        cursor = conn.connection.cursor()
+                        cursor.executemany(sql, list(map(getter, batch)) if getter else batch)
+                        cursor.close()
+                    elif as_dicts:
+                        conn.execute(stmt, batch)
+                    else:
+                        conn.execute(stmt, [dict(zip(columns, row)) for row in batch])
+
+                    count += len(batch)
+                    pending += len(batch)
+                    if pending >= commit_every:
+                        trans.commit()
+                        trans = conn.begin()
+                        pending = 0
+
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+
+        seconds = time.time() - started
+        report.update(rows=count, seconds=seconds, rows_per_sec=count / seconds if seconds else 0.0)
+        logger.info('Inserted {rows} rows into {table} in {seconds:.3f}s ({rows_per_sec:.0f} rows/sec)'.format(**report))
+        return report
+
     def tables_in(self, adict):
         '''Returns a list containing the tables in the context *adict*. Usage::
            tables = sa.tables_in(globals())
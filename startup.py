@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*
+'''Startup cost report for --import-profile.
+
+Kept free of heavy imports itself since it is loaded before everything else.
+'''
+import sys
+import time
+import builtins
+
+FLAG = '--import-profile'
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_phase = _NullPhase()
+
+
+class _Phase(object):
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.depth = self.profile.depth
+        self.profile.depth += 1
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.depth -= 1
+        self.profile.phases.append((self.started, self.depth, self.name, time.perf_counter() - self.started))
+        return False
+
+
+class StartupProfile(object):
+    '''Times imports and named startup phases, reporting them on :meth:`report`.
+
+    Imports are timed by wrapping ``builtins.__import__``, so each module
+    is reported, slowest first, with its own (self) and cumulative time the
+    first time it is imported; modules loaded through
+    ``importlib.import_module``, such as plugins, only count towards the
+    phase that loads them. A disabled profile costs one attribute check
+    per phase.
+    '''
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.imports = []
+        self.phases = []
+        self.depth = 0
+        self._stack = []
+        self._import = None
+        if enabled:
+            self._import = builtins.__import__
+            builtins.__import__ = self._timed_import
+
+    @classmethod
+    def from_argv(cls, argv=None):
+        return cls(FLAG in (sys.argv if argv is None else argv))
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self._import(name, globals, locals, fromlist, level)
+
+        self._stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - started
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            self.imports.append((name, elapsed - children, elapsed, len(self._stack)))
+
+    def phase(self, name):
+        '''Context manager timing one startup phase.'''
+        if not self.enabled:
+            return _null_phase
+        return _Phase(self, name)
+
+    def stop(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    def report(self, write=None, limit=25):
+        '''Write the slowest imports and every phase, in start order.'''
+        if not self.enabled:
+            return
+        self.stop()
+        write = write or sys.stderr.write
+
+        lines = ['Startup profile: {0:.1f} ms total\n'.format((time.perf_counter() - self.started) * 1000)]
+        lines.append('{0:>10} {1:>10}  {2}\n'.format('self ms', 'total ms', 'import'))
+        for name, own, total, depth in sorted(self.imports, key=lambda entry: -entry[1])[:limit]:
+            lines.append('{0:10.2f} {1:10.2f}  {2}\n'.format(own * 1000, total * 1000, name))
+
+        lines.append('{0:>10} {1:>10}  {2}\n'.format('', 'total ms', 'phase'))
+        for _, depth, name, elapsed in sorted(self.phases):
+            lines.append('{0:>10} {1:10.2f}  {2}{3}\n'.format('', elapsed * 1000, '  ' * depth, name))
+        write(''.join(lines))
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*
+import os
+import sys
+
+# the modules live at the top of the repository, next to cli.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
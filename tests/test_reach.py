@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*
+import socket
+import asyncio
+
+import reach
+
+
+def free_port():
+    '''Return a local port nothing listens on.'''
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_service_ports_skips_defaults_and_bad_values():
+    sections = {
+        'DEFAULT': {'port': '80'},
+        'SERVICE': {'port': '80', 'http': '80,81, 8000-8002', 'note': 'not ports'},
+    }
+    assert reach.service_ports(sections) == {'http': frozenset([80, 81, 8000, 8001, 8002])}
+
+
+def test_results_against_local_stand_ins():
+    hang_port = free_port()
+    closed_port = free_port()
+
+    async def connect(host, port):
+        # stands in for a host that never answers
+        if port == hang_port:
+            await asyncio.sleep(60)
+        return await asyncio.open_connection(host, port)
+
+    async def check():
+        async def accept(reader, writer):
+            writer.close()
+
+        server = await asyncio.start_server(accept, '127.0.0.1', 0)
+        open_port = server.sockets[0].getsockname()[1]
+        services = {'web': frozenset([open_port, closed_port]), 'slow': frozenset([hang_port])}
+        engine = reach.Reachability(services, concurrency=2, timeout=0.2, connect=connect)
+        try:
+            results = [result async for result in engine.results(['127.0.0.1'])]
+        finally:
+            server.close()
+            await server.wait_closed()
+        return open_port, results
+
+    open_port, results = asyncio.run(check())
+
+    by_port = dict((result['port'], result) for result in results)
+    assert len(results) == 3
+    assert by_port[open_port]['status'] == reach.OPEN
+    assert by_port[open_port]['services'] == ['web']
+    assert by_port[closed_port]['status'] == reach.CLOSED
+    assert by_port[hang_port]['status'] == reach.TIMEOUT
+    assert by_port[hang_port]['services'] == ['slow']
+
+
+def test_address_cache_does_not_grow_with_targets():
+    targets = ['127.0.0.{0}'.format(ndx) for ndx in range(1, 201)]
+    sizes = []
+
+    async def connect(host, port):
+        sizes.append(len(engine.addresses))
+        raise ConnectionRefusedError()
+
+    engine = reach.Reachability({'web': frozenset([80, 443])}, concurrency=4, connect=connect)
+
+    async def check():
+        return [result async for result in engine.results(targets)]
+
+    results = asyncio.run(check())
+
+    assert len(results) == 400
+    assert max(sizes) <= 4
+    assert engine.addresses == {}
+    assert engine.pending == {}
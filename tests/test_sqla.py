@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*
+import sqlite3
+
+import sqla
+
+
+def make_shards(tmp_path, shard_values):
+    paths = []
+    for ndx, values in enumerate(shard_values):
+        path = str(tmp_path / 'shard{0}.db'.format(ndx))
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE scan (ts, host TEXT)')
+        conn.executemany('INSERT INTO scan VALUES (?, ?)',
+                         [(value, 'h{0}'.format(ndx)) for value in values])
+        conn.commit()
+        conn.close()
+        paths.append(path)
+    return paths
+
+
+def test_order_by_merges_null_and_mixed_type_shards(tmp_path):
+    paths = make_shards(tmp_path, [[3, None, 'b', 1.5], [None, 2, 'a', b'z'], [5]])
+    shards = sqla.ShardedQuery(paths)
+
+    rows = list(shards.execute('SELECT ts FROM scan ORDER BY ts', order_by=[0]))
+    assert [row[0] for row in rows] == [None, None, 1.5, 2, 3, 5, 'a', 'b', b'z']
+
+    rows = list(shards.execute('SELECT ts FROM scan ORDER BY ts DESC', order_by=[0], reverse=True))
+    assert [row[0] for row in rows] == [b'z', 'b', 'a', 5, 3, 2, 1.5, None, None]
+
+
+def test_min_max_aggregates_across_mixed_type_shards(tmp_path):
+    paths = make_shards(tmp_path, [[3, None], ['a', 7], [None]])
+    shards = sqla.ShardedQuery(paths)
+
+    rows = list(shards.execute('SELECT MIN(ts), MAX(ts) FROM scan', aggregate=['min', 'max']))
+    assert rows == [(3, 'a')]
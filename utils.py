@@ -4,6 +4,16 @@ import os
 import logging
 import re
 import hashlib
+import functools
+import sys
+import math
+import time
+import threading
+import mmap
+import array
+import binascii
+import contextlib
+from concurrent import futures
 
 logger = logging.getLogger(__file__)
 
@@ -28,31 +38,99 @@ def chunkFromFile(fileName, chunkSize=8192):
                 break
 
 
-def md5FileHash(filePath):
-    md5 = hashlib.md5()
+# read size used when streaming files through the digests
+HASH_CHUNK_SIZE = 1024 * 1024
 
-    if os.path.exists(filePath):
-        with open(filePath, 'rb') as fp:
-            md5.update(fp.read())
+DEFAULT_DIGESTS = ('md5', 'sha1', 'sha256')
 
-        return md5.hexdigest().upper()
 
-    else:
+def hashFile(filePath, algorithms=DEFAULT_DIGESTS, chunkSize=HASH_CHUNK_SIZE, cache=None):
+    """Hash a file in a single pass, feeding every digest in *algorithms*.
+
+    The file is streamed through one reusable buffer so memory use does not
+    depend on the file size. Returns a dict of algorithm name to upper-case
+    hex digest, or None if *filePath* is not a file. Digests are served from
+    *cache* (a :class:`hashcache.FileHashCache`) when the file is unchanged.
+    """
+    if cache is not None:
+        return cache.hashFile(filePath, algorithms, chunkSize)
+
+    if not os.path.isfile(filePath):
         return None
 
+    hashes = [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
+    buf = bytearray(chunkSize)
+    view = memoryview(buf)
 
+    with open(filePath, 'rb', buffering=0) as fp:
+        while True:
+            size = fp.readinto(buf)
+            if not size:
+                break
+            chunk = view[:size]
+            for _, digest in hashes:
+                digest.update(chunk)
 
+    return dict((algorithm, digest.hexdigest().upper()) for algorithm, digest in hashes)
 
-def sha1hashFile(filePath):
-    sha = hashlib.sha1()
 
-    if os.path.isfile(filePath):
-        with open(filePath, 'rb') as fp:
-            sha.update(fp.read())
+def _hashFileEntry(filePath, algorithms=DEFAULT_DIGESTS, chunkSize=HASH_CHUNK_SIZE):
+    try:
+        return filePath, hashFile(filePath, algorithms, chunkSize)
+    except OSError as err:
+        # unreadable, or gone since the walk listed it; one file shouldn't end the whole tree
+        logger.warning('Not hashed {0}: {1!r}'.format(filePath, err))
+        return filePath, None
+
+
+def walkFiles(rootPath):
+    for dirPath, _, fileNames in os.walk(rootPath):
+        for fileName in fileNames:
+            yield os.path.join(dirPath, fileName)
+
 
-        return sha.hexdigest().upper()
+def hashPaths(filePaths, algorithms=DEFAULT_DIGESTS, workers=None, chunkSize=HASH_CHUNK_SIZE, pool=None):
+    """Hash *filePaths* on a process pool, yielding (path, digests) in order.
+
+    The pool is created for the call unless an executor is given as *pool*.
+    """
+    task = functools.partial(_hashFileEntry, algorithms=tuple(algorithms), chunkSize=chunkSize)
+    if pool is not None:
+        for entry in pool.map(task, filePaths, chunksize=16):
+            yield entry
+        return
+
+    with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for entry in pool.map(task, filePaths, chunksize=16):
+            yield entry
+
+
+def hashTree(rootPath, algorithms=DEFAULT_DIGESTS, workers=None, chunkSize=HASH_CHUNK_SIZE, cache=None):
+    """Hash every file below *rootPath* on a process pool.
+
+    Yields (path, digests) tuples in walk order; *digests* is None for
+    entries that are not regular files (broken links, sockets...) or
+    can't be read. With a
+    :class:`hashcache.FileHashCache` as *cache* only new or changed files
+    are read.
+    """
+    if cache is not None:
+        entries = cache.hashFiles(walkFiles(rootPath), algorithms, workers, chunkSize)
     else:
-        return None
+        entries = hashPaths(walkFiles(rootPath), algorithms, workers, chunkSize)
+
+    for entry in entries:
+        yield entry
+
+
+def md5FileHash(filePath):
+    digests = hashFile(filePath, ('md5',))
+    return digests['md5'] if digests else None
+
+
+def sha1hashFile(filePath):
+    digests = hashFile(filePath, ('sha1',))
+    return digests['sha1'] if digests else None
 
 
 
@@ -64,16 +142,8 @@ def sha1hashStr(str):
 
 
 def sha256FileHash(filePath):
-    sha = hashlib.sha256()
-
-    if os.path.exists(filePath):
-        with open(filePath, 'rb') as fp:
-            sha.update(fp.read())
-
-        return sha.hexdigest().upper()
-
-    else:
-        return None
+    digests = hashFile(filePath, ('sha256',))
+    return digests['sha256'] if digests else None
 
 
 
@@ -81,7 +151,7 @@ def renameFile(src, dst, verbose):
     try:
         os.rename(src, dst)
         if verbose:
-            print 'Move file from %s to %s' % (src, dst)
+            print('Move file from %s to %s' % (src, dst))
         return True
     except OSError:
         pass
@@ -92,7 +162,7 @@ def replaceFile(src, dst, verbose):
         os.remove(dst)
         os.rename(src, dst)
         if verbose:
-            print 'Replace file %s with %s' % (dst, src)
+            print('Replace file %s with %s' % (dst, src))
 
     except OSError:
         pass
@@ -102,7 +172,7 @@ def removeFile(src, verbose):
     try:
         os.remove(src)
         if verbose:
-            print 'Remove file %s' % src
+            print('Remove file %s' % src)
         return True
     except OSError:
         pass
@@ -185,8 +255,13 @@ class JSONEncoder(json.JSONEncoder):
 
 
 def contains(small, big):
-    for i in xrange(len(big) - len(small)+1):
-        for j in xrange(len(small)):
+    """Return the (start, end) of the first occurrence of *small* in *big*, else False."""
+    if isinstance(big, (bytes, bytearray, str)):
+        i = big.find(small)
+        return (i, i + len(small)) if i != -1 else False
+
+    for i in range(len(big) - len(small)+1):
+        for j in range(len(small)):
             if big[i+j] != small[j]:
                 break
         else:
@@ -194,59 +269,433 @@ def contains(small, big):
     return False
 
 
+# read size used by searchFile when a file can't be memory mapped
+SEARCH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def findAll(pattern, data, start=0, end=None):
+    """Yield the offset of every occurrence of *pattern* in *data*.
+
+    *data* is anything with a ``bytes.find`` style method (bytes, bytearray,
+    mmap). Overlapping occurrences are all reported.
+    """
+    if not pattern:
+        raise ValueError('Empty search pattern')
+
+    end = len(data) if end is None else end
+    find = data.find
+    pos = find(pattern, start, end)
+    while pos != -1:
+        yield pos
+        pos = find(pattern, pos + 1, end)
+
+
+def searchFile(fileName, pattern, chunkSize=SEARCH_CHUNK_SIZE, useMmap=True):
+    """Yield the offset of every occurrence of *pattern* in a file.
+
+    Regular files are memory mapped and searched in place; anything that
+    can't be mapped (empty files, pipes) is streamed in *chunkSize* reads
+    with the last ``len(pattern) - 1`` bytes carried over so matches that
+    span two reads are still found.
+    """
+    if not pattern:
+        raise ValueError('Empty search pattern')
+
+    with open(fileName, 'rb') as f:
+        mm = None
+        if useMmap:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                mm = None
+
+        if mm is not None:
+            with contextlib.closing(mm):
+                if hasattr(mm, 'madvise'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                for pos in findAll(pattern, mm):
+                    yield pos
+            return
+
+        overlap = len(pattern) - 1
+        consumed = 0
+        buf = b''
+        while True:
+            chunk = f.read(chunkSize)
+            if not chunk:
+                break
+            consumed += len(chunk)
+            buf = buf[-overlap:] + chunk if overlap else chunk
+            base = consumed - len(buf)
+            for pos in findAll(pattern, buf):
+                yield base + pos
+
+
+
+
+class Histogram(object):
+    """Log-linear latency histogram with ~6% relative bucket error.
+
+    Values are recorded in seconds and bucketed in whole microseconds:
+    exactly below 32us, then 16 buckets per power of two. Buckets are kept
+    sparse so histograms are cheap to copy, pickle and merge.
+    """
+    __slots__ = ('buckets', 'count', 'total', 'min', 'max')
+
+    SUB_BUCKETS = 16
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def index(cls, micros):
+        if micros < 2 * cls.SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - 5
+        return cls.SUB_BUCKETS * shift + (micros >> shift)
+
+    @classmethod
+    def bounds(cls, index):
+        """Return the (lowest, highest) microsecond value of a bucket"""
+        if index < 2 * cls.SUB_BUCKETS:
+            return index, index
+        shift = index // cls.SUB_BUCKETS - 1
+        mantissa = index - cls.SUB_BUCKETS * shift
+        return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds):
+        micros = int(seconds * 1000000) if seconds > 0 else 0
+        index = self.index(micros)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        return self
+
+    def copy(self):
+        return Histogram().merge(self)
+
+    def percentile(self, pct):
+        """Return the value (seconds) at percentile *pct* (0-100), or None"""
+        if not self.count:
+            return None
+
+        rank = max(1, int(math.ceil(self.count * pct / 100.0)))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                low, high = self.bounds(index)
+                value = (low + high) / 2.0 / 1000000
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+class _StatsShard(object):
+    """Counters and histograms updated by a single thread"""
+    __slots__ = ('lock', 'counts', 'histograms')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.histograms = {}
 
 
 class Stats:
+    """Thread-safe event counters and latency histograms.
+
+    Each thread updates its own shard under an uncontended lock, so
+    :meth:`update` and :meth:`observe` stay cheap with many writers;
+    :meth:`snapshot` merges the shards. Snapshots are plain picklable
+    dicts, so worker processes can send theirs back to be folded in with
+    :meth:`merge`.
+    """
+
     def __init__(self, name=None, verbose=False):
         if name:
             self.name = name
         else:
             self.name = "Stats"
-        self.statusDict = dict()
         self.verbose = verbose
-        self.entry = 0
-
-    def update(self, event):
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _StatsShard()
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def update(self, event, count=1):
         if self.verbose:
             print(event)
 
-        #if self.entry % 100 == 0:
-        #    sys.stdout.write('.')
-        self.entry += 1
+        shard = self._shard()
+        with shard.lock:
+            shard.counts[event] += count
+
+    def observe(self, name, seconds):
+        """Record a latency of *seconds* in the histogram *name*"""
+        shard = self._shard()
+        with shard.lock:
+            histogram = shard.histograms.get(name)
+            if histogram is None:
+                histogram = shard.histograms[name] = Histogram()
+            histogram.record(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Time the enclosed block into the histogram *name*"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """Return {'name', 'counters', 'histograms'} merged across threads"""
+        counters = collections.Counter()
+        histograms = {}
+        with self._shards_lock:
+            shards = list(self._shards)
+
+        for shard in shards:
+            with shard.lock:
+                counters.update(shard.counts)
+                for name, histogram in shard.histograms.items():
+                    if name in histograms:
+                        histograms[name].merge(histogram)
+                    else:
+                        histograms[name] = histogram.copy()
+
+        return {'name': self.name, 'counters': dict(counters), 'histograms': histograms}
+
+    def merge(self, snapshot):
+        """Fold a snapshot (e.g. from a worker process) into these stats"""
+        shard = self._shard()
+        with shard.lock:
+            shard.counts.update(snapshot['counters'])
+            for name, histogram in snapshot['histograms'].items():
+                if name in shard.histograms:
+                    shard.histograms[name].merge(histogram)
+                else:
+                    shard.histograms[name] = histogram.copy()
 
-        if self.statusDict.has_key(event):
-            self.statusDict[event] += 1
-        else:
-            self.statusDict[event] = 1
+    @property
+    def statusDict(self):
+        return self.snapshot()['counters']
+
+    @property
+    def entry(self):
+        return sum(self.statusDict.values())
+
+    def _lines(self, snapshot):
+        for key, count in snapshot['counters'].items():
+            yield "{0} : {1}".format(key, count)
+        for key, histogram in snapshot['histograms'].items():
+            summary = histogram.summary()
+            yield "{0} : count={1} mean={2} p50={3} p95={4} p99={5} max={6}".format(
+                key, summary['count'], fmtseconds(summary['mean']), fmtseconds(summary['p50']),
+                fmtseconds(summary['p95']), fmtseconds(summary['p99']), fmtseconds(summary['max']))
 
     def printStats(self):
-        for key in self.statusDict.iterkeys():
-            print("{0} : {1} - {2}".format(self.name, key, self.statusDict[key]))
+        for line in self._lines(self.snapshot()):
+            print("{0} : {1}".format(self.name, line))
 
     def stringStats(self):
         statStr = str("\n")
-        for key in self.statusDict.iterkeys():
-            statStr += "{0} : {1}\n".format(key, self.statusDict[key])
+        for line in self._lines(self.snapshot()):
+            statStr += "{0}\n".format(line)
 
         return statStr
 
+    def export(self, interval=10.0, textfile=None, jsonl=None):
+        """Start and return a :class:`StatsExporter` for these stats"""
+        return StatsExporter(self, interval, textfile, jsonl).start()
+
     def logStats(self, filename=None):
         if filename:
             logFile = filename
         else:
             logFile = '{0}.stats'.format(self.name)
         with open(logFile, 'a') as f:
-            for key in self.statusDict.iterkeys():
-                f.write("{0} : {1}\n".format(key, self.statusDict[key]))
+            for line in self._lines(self.snapshot()):
+                f.write("{0}\n".format(line))
+
+
+def _prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class StatsExporter(object):
+    """Periodically flush :class:`Stats` snapshots from a background thread.
+
+    Every *interval* seconds the exporter snapshots *stats* and writes:
+
+    * *textfile*: the current values in Prometheus text format, replaced
+      atomically (suitable for node_exporter's textfile collector).
+    * *jsonl*: one JSON line appended per flush with counters, deltas and
+      per-second rates since the previous flush, and histogram summaries.
+
+    Threads calling :meth:`Stats.update` only ever wait for their own
+    shard to be copied; all formatting and file I/O happens on the
+    exporter thread. Usage::
+
+        with StatsExporter(stats, interval=10, jsonl='scan.stats.jsonl'):
+            run_scan(stats)
+    """
+
+    def __init__(self, stats, interval=10.0, textfile=None, jsonl=None, prefix='bitrunner'):
+        self.stats = stats
+        self.interval = interval
+        self.textfile = textfile
+        self.jsonl = jsonl
+        self.prefix = prefix
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._previous = {}
+        self._previous_time = time.time()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='StatsExporter')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the exporter thread after one final flush"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._safe_flush()
+        self._safe_flush()
+
+    def _safe_flush(self):
+        try:
+            self.flush()
+        except Exception as err:
+            self.log.exception('Stats export failed: {0!r}'.format(err))
+
+    def flush(self):
+        now = time.time()
+        snapshot = self.stats.snapshot()
+        elapsed = now - self._previous_time
+        counters = snapshot['counters']
+
+        deltas = dict((key, count - self._previous.get(key, 0)) for key, count in counters.items())
+        rates = dict((key, delta / elapsed if elapsed > 0 else 0.0) for key, delta in deltas.items())
+        self._previous = counters
+        self._previous_time = now
+
+        if self.textfile:
+            self.write_textfile(snapshot, rates)
+        if self.jsonl:
+            record = {
+                'time': now,
+                'name': snapshot['name'],
+                'interval': elapsed,
+                'counters': counters,
+                'deltas': deltas,
+                'rates': rates,
+                'histograms': dict((key, histogram.summary())
+                                   for key, histogram in snapshot['histograms'].items()),
+            }
+            with open(self.jsonl, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def write_textfile(self, snapshot, rates):
+        name = _prometheus_label(snapshot['name'])
+        lines = [
+            '# HELP {0}_events_total Events counted by Stats.update'.format(self.prefix),
+            '# TYPE {0}_events_total counter'.format(self.prefix),
+        ]
+        for key, count in sorted(snapshot['counters'].items()):
+            lines.append('{0}_events_total{{stats="{1}",event="{2}"}} {3}'.format(
+                self.prefix, name, _prometheus_label(key), count))
+
+        lines.extend([
+            '# HELP {0}_event_rate Events per second over the last export interval'.format(self.prefix),
+            '# TYPE {0}_event_rate gauge'.format(self.prefix),
+        ])
+        for key, rate in sorted(rates.items()):
+            lines.append('{0}_event_rate{{stats="{1}",event="{2}"}} {3!r}'.format(
+                self.prefix, name, _prometheus_label(key), rate))
+
+        lines.extend([
+            '# HELP {0}_latency_seconds Latencies recorded by Stats.observe'.format(self.prefix),
+            '# TYPE {0}_latency_seconds summary'.format(self.prefix),
+        ])
+        for key, histogram in sorted(snapshot['histograms'].items()):
+            labels = 'stats="{0}",name="{1}"'.format(name, _prometheus_label(key))
+            for quantile in (50, 95, 99):
+                lines.append('{0}_latency_seconds{{{1},quantile="{2}"}} {3!r}'.format(
+                    self.prefix, labels, quantile / 100.0, histogram.percentile(quantile)))
+            lines.append('{0}_latency_seconds_sum{{{1}}} {2!r}'.format(self.prefix, labels, histogram.total))
+            lines.append('{0}_latency_seconds_count{{{1}}} {2}'.format(self.prefix, labels, histogram.count))
+
+        tmp_path = '{0}.tmp'.format(self.textfile)
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.textfile)
+
+
+def fmtseconds(seconds):
+    if seconds is None:
+        return '-'
+    return '{0:.6f}s'.format(seconds)
 
 
 #=========================================================================
 # tracer
 #=========================================================================
 
-import functools
 import inspect
-import sys
+import random
+import queue
 
 
 def name(item):
@@ -256,7 +705,7 @@ def name(item):
 
 def is_classmethod(instancemethod):
   """Determine if an instancemethod is a classmethod."""
-  return instancemethod.im_self is not None
+  return isinstance(getattr(instancemethod, "__self__", None), type)
 
 
 def is_class_private_name(member_name):
@@ -273,7 +722,8 @@ def method_name(method):
   """
   mname = name(method)
   if is_class_private_name(mname):
-    mname = "_%s%s" % (name(method.im_class), mname)
+    owner = method.__qualname__.rsplit(".", 1)[0]
+    mname = "_%s%s" % (owner.lstrip("_"), mname)
   return mname
 
 
@@ -287,94 +737,328 @@ def format_arg_value(arg_val):
   return "%s=%r" % (arg, val)
 
 
-def trace(func, write=sys.stdout.write):
-  """Echo calls to a function.
+class TraceRecord(object):
+  """One traced call. Arguments are kept as references and only formatted
+  when the record is written, so a record shows their state at that time."""
+  __slots__ = ("func", "args", "kwargs", "start", "elapsed", "error")
 
-  Returns a decorated version of the input function which "tracees" calls
-  made to it by writing out the function's name and the arguments it was
-  called with.
-  """
-  # Unpack function's arg count, arg names, arg defaults
-  code = func.func_code
-  argcount = code.co_argcount
-  argnames = code.co_varnames[:argcount]
-  fn_defaults = func.func_defaults or list()
-  argdefs = dict(zip(argnames[-len(fn_defaults):], fn_defaults))
-
-  @functools.wraps(func)
-  def wrapped(*v, **k):
-    """Collect function arguments by chaining together positional,
-defaulted, extra positional and keyword arguments."""
-    positional = map(format_arg_value, zip(argnames, v))
+  def __init__(self, func, args, kwargs, start, elapsed, error):
+    self.func = func
+    self.args = args
+    self.kwargs = kwargs
+    self.start = start
+    self.elapsed = elapsed
+    self.error = error
+
+  def format(self):
+    code = self.func.__code__
+    argcount = code.co_argcount
+    argnames = code.co_varnames[:argcount]
+    fn_defaults = self.func.__defaults__ or ()
+    argdefs = dict(zip(argnames[len(argnames) - len(fn_defaults):], fn_defaults))
+
+    positional = [format_arg_value(a) for a in zip(argnames, self.args)]
     defaulted = [format_arg_value((a, argdefs[a]))
-                 for a in argnames[len(v):] if a not in k]
-    nameless = map(repr, v[argcount:])
-    keyword = map(format_arg_value, k.items())
+                 for a in argnames[len(self.args):] if a in argdefs and a not in self.kwargs]
+    nameless = [repr(a) for a in self.args[argcount:]]
+    keyword = [format_arg_value(a) for a in self.kwargs.items()]
     args = positional + defaulted + nameless + keyword
-    write("%s(%s)\n" % (name(func), ", ".join(args)))
-    return func(*v, **k)
+    outcome = " !%r" % (self.error,) if self.error is not None else ""
+    return "%s(%s) %.6fs%s\n" % (name(self.func), ", ".join(args), self.elapsed, outcome)
+
+
+class Tracer(object):
+  """Sampled call tracer keeping the last calls in a ring buffer.
+
+  Only a *sample_rate* fraction of calls is recorded. Each recorded call
+  (function, argument references, duration, exception) goes into a ring
+  buffer of the last *buffer_size* calls, which :meth:`dump` writes out,
+  e.g. from an error handler. If *write* is given, records are also
+  formatted and written by a background thread; when its queue is full
+  records are dropped (counted in :attr:`dropped`) rather than blocking
+  the traced code. With *background* False they are written inline.
+  """
+
+  def __init__(self, sample_rate=1.0, buffer_size=1000, write=None, background=True, queue_size=10000):
+    self.sample_rate = sample_rate
+    self.records = collections.deque(maxlen=buffer_size)
+    self.write = write
+    self.dropped = 0
+    self._queue = None
+    self._thread = None
+    if write is not None and background:
+      self._queue = queue.Queue(queue_size)
+      self._thread = threading.Thread(target=self._writer, name="Tracer")
+      self._thread.daemon = True
+      self._thread.start()
+
+  def _writer(self):
+    while True:
+      record = self._queue.get()
+      if record is None:
+        return
+      lines = [record.format()]
+      # batch up whatever else is already waiting
+      while len(lines) < 1000:
+        try:
+          record = self._queue.get_nowait()
+        except queue.Empty:
+          break
+        if record is None:
+          self.write("".join(lines))
+          return
+        lines.append(record.format())
+      self.write("".join(lines))
+
+  def _emit(self, record):
+    self.records.append(record)
+    if self._queue is not None:
+      try:
+        self._queue.put_nowait(record)
+      except queue.Full:
+        self.dropped += 1
+    elif self.write is not None:
+      self.write(record.format())
+
+  def wrap(self, func):
+    """Return a traced version of *func*."""
+    sample_rate = self.sample_rate
+    rand = random.random
+    timer = time.perf_counter
+
+    @functools.wraps(func)
+    def wrapped(*v, **k):
+      if sample_rate < 1.0 and rand() >= sample_rate:
+        return func(*v, **k)
+      start = timer()
+      error = None
+      try:
+        return func(*v, **k)
+      except BaseException as err:
+        error = err
+        raise
+      finally:
+        self._emit(TraceRecord(func, v, k, start, timer() - start, error))
+
+    return wrapped
+
+  def dump(self, write=None, last=None):
+    """Write the last *last* (default all) buffered calls to *write*."""
+    write = write or self.write or sys.stdout.write
+    records = list(self.records)
+    if last is not None:
+      records = records[-last:]
+    write("".join(record.format() for record in records))
+
+  def close(self):
+    """Flush and stop the background writer."""
+    if self._thread is not None:
+      self._queue.put(None)
+      self._thread.join()
+      self._thread = None
+
+
+def default_tracer(write, sample_rate=1.0):
+  """Tracer for the trace helpers when none is given.
+
+  Records are written from a background thread, so tracing a hot
+  function doesn't make it wait on *write*, and the tracer is flushed
+  at exit.
+  """
+  import atexit
+
+  tracer = Tracer(sample_rate, write=write)
+  atexit.register(tracer.close)
+  return tracer
+
+
+def trace(func, write=sys.stdout.write, tracer=None, sample_rate=1.0):
+  """Echo calls to a function.
 
-  return wrapped
+  Returns a decorated version of the input function which "tracees" calls
+  made to it by writing out the function's name, the arguments it was
+  called with and how long the call took. Only a *sample_rate* fraction
+  of calls is traced; pass a :class:`Tracer` to share one between helpers.
+  """
+  tracer = tracer or default_tracer(write, sample_rate)
+  return tracer.wrap(func)
 
 
-def trace_instancemethod(klass, method, write=sys.stdout.write):
+def trace_instancemethod(klass, method, write=sys.stdout.write, tracer=None, sample_rate=1.0):
   """Change an instancemethod so that calls to it are traceed.
 
   Replacing a classmethod is a little more tricky.
   See: http://www.python.org/doc/current/ref/types.html
   """
+  tracer = tracer or default_tracer(write, sample_rate)
   mname = method_name(method)
   never_trace = "__str__", "__repr__",  # Avoid recursion printing method calls
   if mname in never_trace:
     pass
   elif is_classmethod(method):
-    setattr(klass, mname, classmethod(trace(method.im_func, write)))
+    setattr(klass, mname, classmethod(tracer.wrap(method.__func__)))
   else:
-    setattr(klass, mname, trace(method, write))
+    setattr(klass, mname, tracer.wrap(method))
 
 
-def trace_class(klass, write=sys.stdout.write):
+def trace_class(klass, write=sys.stdout.write, tracer=None, sample_rate=1.0):
   """Echo calls to class methods and static functions
   """
-  for _, method in inspect.getmembers(klass, inspect.ismethod):
-    trace_instancemethod(klass, method, write)
-  for _, func in inspect.getmembers(klass, inspect.isfunction):
-    setattr(klass, name(func), staticmethod(trace(func, write)))
-
-
-def trace_module(mod, write=sys.stdout.write):
+  tracer = tracer or default_tracer(write, sample_rate)
+  never_trace = "__str__", "__repr__",  # Avoid recursion printing method calls
+  for mname, _ in inspect.getmembers(klass):
+    attr = inspect.getattr_static(klass, mname)
+    if mname in never_trace:
+      continue
+    if isinstance(attr, staticmethod):
+      setattr(klass, mname, staticmethod(tracer.wrap(attr.__func__)))
+    elif isinstance(attr, classmethod):
+      setattr(klass, mname, classmethod(tracer.wrap(attr.__func__)))
+    elif inspect.isfunction(attr):
+      setattr(klass, mname, tracer.wrap(attr))
+
+
+def trace_module(mod, write=sys.stdout.write, tracer=None, sample_rate=1.0):
   """Echo calls to functions and methods in a module.
   """
+  tracer = tracer or default_tracer(write, sample_rate)
   for fname, func in inspect.getmembers(mod, inspect.isfunction):
-    setattr(mod, fname, trace(func, write))
+    setattr(mod, fname, tracer.wrap(func))
   for _, klass in inspect.getmembers(mod, inspect.isclass):
-    trace_class(klass, write)
+    trace_class(klass, write, tracer, sample_rate)
+
+
 
 
 
+FILTER = bytes(x if 32 <= x < 127 else ord('.') for x in range(256))
 
+HEX_BYTES = ['%02x' % x for x in range(256)]
+
+# lines formatted per slice of the source in _hexdumpBlocks
+HEXDUMP_BLOCK_LINES = 4096
+
+
+def _hexdumpLine(line, n, length, prefix):
+    left = length // 2
+    right = length - left
+    l, r = line[:left], line[left:]
+    hexa = "%-*s" % (left*3, ' '.join([HEX_BYTES[x] for x in l]))
+    hexb = "%-*s" % (right*3, ' '.join([HEX_BYTES[x] for x in r]))
+    lf = l.translate(FILTER).decode('ascii')
+    rf = r.translate(FILTER).decode('ascii')
+    return "%s%04x  %s %s %s %s\n" % (prefix, n, hexa, hexb, lf, rf)
+
+
+def _hexdumpBlock(block, start, length, prefix):
+    """Format the whole lines of *block* at once.
+
+    Every full line has the same layout, so each column is filled for all
+    lines with a single extended slice assignment rather than formatting
+    line by line. Returns None if the offset column changes width within
+    the block.
+    """
+    lines = len(block) // length
+    width = len('%04x' % (start + (lines - 1) * length))
+    if len('%04x' % start) != width:
+        return None
+
+    left = length // 2
+    prefix = prefix.encode('utf-8')
+    hexStart = len(prefix) + width + 2
+    textStart = hexStart + length * 3 + 2
+    lineSize = textStart + length + 2
+
+    out = bytearray(b' ') * (lines * lineSize)
+    out[lineSize - 1::lineSize] = b'\n' * lines
+    for ndx in range(len(prefix)):
+        out[ndx::lineSize] = prefix[ndx:ndx + 1] * lines
+
+    # hexlify the offsets as big-endian 64 bit words and keep the low digits
+    offsets = array.array('Q', range(start, start + lines * length, length))
+    if sys.byteorder == 'little':
+        offsets.byteswap()
+    offsets = binascii.hexlify(offsets.tobytes())
+    for ndx in range(width):
+        out[len(prefix) + ndx::lineSize] = offsets[16 - width + ndx::16]
+
+    hexa = binascii.hexlify(block)
+    text = block.translate(FILTER)
+    for ndx in range(length):
+        gap = 1 if ndx >= left else 0
+        pos = hexStart + ndx * 3 + gap
+        out[pos::lineSize] = hexa[ndx * 2::length * 2]
+        out[pos + 1::lineSize] = hexa[ndx * 2 + 1::length * 2]
+        out[textStart + ndx + gap::lineSize] = text[ndx::length]
+
+    return out.decode('utf-8')
+
+
+def _hexdumpBlocks(data, length=16, prefix='', offset=0, size=None):
+    """Yield the hexdump of *data* as newline terminated blocks of lines."""
+    end = len(data) if size is None else min(len(data), offset + size)
+    blockSize = length * HEXDUMP_BLOCK_LINES
+
+    for blockStart in range(offset, end, blockSize):
+        block = bytes(data[blockStart:min(blockStart + blockSize, end)])
+        whole = len(block) - len(block) % length
+
+        formatted = _hexdumpBlock(block[:whole], blockStart, length, prefix) if whole else ''
+        if formatted is None:
+            formatted = ''.join([_hexdumpLine(block[ndx:ndx + length], blockStart + ndx, length, prefix)
+                                 for ndx in range(0, whole, length)])
+        if whole < len(block):
+            formatted += _hexdumpLine(block[whole:], blockStart + whole, length, prefix)
+
+        yield formatted
+
+
+@contextlib.contextmanager
+def _hexdumpSource(src):
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        yield memoryview(src)
+        return
+
+    with open(src, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            yield b''
+            return
+        with contextlib.closing(mm):
+            yield mm
+
+
+def hexdumpLines(src, length=16, prefix='', offset=0, size=None):
+    """Yield the hexdump of *src* one line at a time.
+
+    *src* is a bytes-like object or a file path; files are memory mapped so
+    only the lines being formatted are ever in memory. *offset* and *size*
+    select a region, and line offsets are absolute within *src*.
+    """
+    with _hexdumpSource(src) as data:
+        for lines in _hexdumpBlocks(data, length, prefix, offset, size):
+            for line in lines.split('\n')[:-1]:
+                yield line
+
+
+def writeHexdump(src, stream=None, length=16, prefix='', offset=0, size=None):
+    """Write the hexdump of *src* (see :func:`hexdumpLines`) to *stream*."""
+    stream = stream or sys.stdout
+    with _hexdumpSource(src) as data:
+        for lines in _hexdumpBlocks(data, length, prefix, offset, size):
+            stream.write(lines)
 
-FILTER=''.join([(len(repr(chr(x)))==3) and chr(x) or '.' for x in range(256)])
 
 def hexdump(src, length=16, prefix=''):
     """
         Print hexdump of string
 
-        >>> print hexdump("abcd\x00" * 4)
+        >>> print(hexdump(b"abcd\x00" * 4))
         0000  61 62 63 64 00 61 62 63  64 00 61 62 63 64 00 61  abcd.abc d.abcd.a
         0010  62 63 64 00                                       bcd.
     """
-    n = 0
-    left = length / 2
-    right = length - left
-    result= []
-    while src:
-        s,src = src[:length],src[length:]
-        l,r = s[:left],s[left:]
-        hexa = "%-*s" % (left*3,' '.join(["%02x"%ord(x) for x in l]))
-        hexb = "%-*s" % (right*3,' '.join(["%02x"%ord(x) for x in r]))
-        lf = l.translate(FILTER)
-        rf = r.translate(FILTER)
-        result.append("%s%04x  %s %s %s %s" % (prefix, n, hexa, hexb, lf, rf))
-        n += length
-    return "\n".join(result)
+    if isinstance(src, str):
+        src = src.encode('latin-1')
+    return "\n".join(hexdumpLines(src, length, prefix))